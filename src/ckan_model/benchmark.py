@@ -0,0 +1,298 @@
+import collections
+import contextlib
+import json
+import os
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import RequestFactory
+from profile import views as profile_views
+from search import views as search_views
+
+from . import cache, client, fake, identity, index, metrics, \
+    production, replica
+from .models import PortfolioLink
+
+# CKAN calls which scenarios may make
+BUDGETS = os.path.join(os.path.dirname(__file__), 'benchmark_budgets.json')
+
+Result = collections.namedtuple('Result', 'scenario wall calls bytes peak')
+
+SCENARIOS = collections.OrderedDict()  # name -> function(data)
+
+
+def scenario(name):
+    """Register function as benchmark scenario. Function gets
+    dictionary returned by generate.
+    """
+    def decorator(function):
+        SCENARIOS[name] = function
+        return function
+    return decorator
+
+
+def generate(ckan, students=10000, items=3, tags=200, universities=10,
+             seed=0):
+    """Fill fake CKAN with synthetic students. Every student has
+    portfolio with items, tags of items are chosen with Zipf
+    distribution, so few tags are popular as in real data.
+
+    :param ckan: fake.FakeCKAN
+    :param students: number of students
+    :param items: number of portfolio items of every student
+    :param tags: number of distinct tags
+    :param universities: number of universities
+    :param seed: seed of random generator
+    :return: dictionary {'students': [user ids], 'tags': [tags by
+             popularity], 'universities': [names], 'recruiter': user id}
+    """
+    rnd = random.Random(seed)
+    admin = ckan.sysadmin['apikey']
+
+    def call(action, data, apikey=admin):
+        return ckan.call_action(action, data, apikey=apikey)
+
+    unis = [call('organization_create', {
+        'name': 'uni-{}'.format(i),
+        'title': 'University {}'.format(i),
+        'extras': [{'key': 'Category', 'value': 'University'}]})['name']
+        for i in range(universities)]
+    tag_names = ['tag{:04}'.format(i) for i in range(tags)]
+    weights = [1 / (i + 1) for i in range(tags)]
+
+    # store is filled by bulk calls, call_action would copy every result
+    users = ckan.bulk(('user_create', {
+        'name': 'student-{:07}'.format(i),
+        'email': 'student-{:07}@example.com'.format(i),
+        'fullname': 'Student {}'.format(i)}, admin)
+        for i in range(students))
+
+    def calls(i, user):
+        uni = unis[i % len(unis)]
+        yield ('organization_member_create',
+               {'id': uni, 'username': user['id'], 'role': 'editor'}, admin)
+        for group in ('students', 'students-work'):
+            yield ('group_member_create',
+                   {'id': group, 'username': user['id'], 'role': 'member'},
+                   admin)
+
+        works = [set(rnd.choices(tag_names, weights, k=3))
+                 for _ in range(items)]
+        counts = collections.Counter(tag for work in works for tag in work)
+        yield ('package_create', {
+            'name': user['name'] + 'profile',
+            'title': user['fullname'],
+            'author': user['name'],
+            'owner_org': uni,
+            'groups': [{'name': 'students'}],
+            'tags': [{'name': tag} for tag in sorted(counts)],
+            'extras': [{'key': 'tag_counts',
+                        'value': json.dumps(counts, sort_keys=True)}]},
+            user['apikey'])
+        for j, work in enumerate(works):
+            yield ('package_create', {
+                'name': '{}-work-{}'.format(user['name'], j),
+                'title': 'Work {}'.format(j),
+                'author': user['name'],
+                'notes': 'Description',
+                'owner_org': uni,
+                'groups': [{'name': 'students-work'}],
+                'tags': [{'name': tag} for tag in sorted(work)]},
+                user['apikey'])
+
+    ckan.bulk(call for i, user in enumerate(users)
+              for call in calls(i, user))
+    ids = [user['id'] for user in users]
+
+    recruiter = call('user_create', {'name': 'recruiter',
+                                     'email': 'recruiter@example.com',
+                                     'fullname': 'Recruiter'})
+    call('organization_create', {
+        'name': 'company',
+        'title': 'Company',
+        'extras': [{'key': 'Category', 'value': 'Company'}]},
+        recruiter['apikey'])
+    return {'students': ids,
+            'tags': tag_names,
+            'universities': unis,
+            'recruiter': recruiter['id']}
+
+
+def _reset():
+    # every run starts with empty caches, so it shows its cost in CKAN
+    cache.invalidate('tags_list', 'top_tags', 'university_list')
+
+
+def run(name, data, repeat=5):
+    """Run scenario. First run measures CKAN calls and peak memory,
+    wall time is median of other runs (made without tracing memory).
+
+    :param name: name of scenario
+    :param data: dictionary returned by generate
+    :param repeat: number of timed runs
+    :return: Result
+    """
+    function = SCENARIOS[name]
+
+    _reset()
+    tracemalloc.start()
+    metrics.start()
+    try:
+        with identity.scope():
+            function(data)
+    finally:
+        calls = metrics.stop()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        _reset()
+        begin = time.perf_counter()
+        with identity.scope():
+            function(data)
+        times.append(time.perf_counter() - begin)
+    return Result(name,
+                  statistics.median(times) if times else None,
+                  len(calls),
+                  sum(call.size or 0 for call in calls),
+                  peak)
+
+
+def table(results):
+    """Lines of table of results, wall time is '-' when scenario wasn't
+    timed (repeat 0).
+
+    :param results: list of Result
+    :return: list of strings
+    """
+    lines = ['{:<20} {:>10} {:>6} {:>10} {:>10}'.format(
+        'scenario', 'wall ms', 'calls', 'bytes', 'peak KiB')]
+    for result in results:
+        wall = '-' if result.wall is None else \
+            '{:.1f}'.format(result.wall * 1000)
+        lines.append('{:<20} {:>10} {:>6} {:>10} {:>10.0f}'.format(
+            result.scenario, wall, result.calls, result.bytes,
+            result.peak / 1024))
+    return lines
+
+
+def over_budget(results, budgets):
+    """Scenarios which made more CKAN calls than their budget.
+
+    :param results: list of Result
+    :param budgets: dictionary {scenario: calls}
+    :return: list of messages
+    """
+    return ['{}: {} CKAN calls, budget {}'.format(
+        result.scenario, result.calls, budgets[result.scenario])
+        for result in results
+        if result.scenario in budgets and
+        result.calls > budgets[result.scenario]]
+
+
+@contextlib.contextmanager
+def environment(students=10000, items=3, latency=0.0, seed=0):
+    """Fake CKAN with generated data used by all clients, together with
+    site users of one student and recruiter for views. Cache, tag index
+    and replica of site are replaced for the block, so neither results
+    from fake CKAN nor invalidations of benchmark reach them. Site users
+    are removed when block ends.
+
+    example:
+    with environment(students=1000) as data:
+        result = run('search', data)
+
+    :param students: number of students
+    :param items: number of portfolio items of every student
+    :param latency: seconds added to every CKAN call
+    :param seed: seed of random generator
+    :return: context manager giving data for scenarios
+    """
+    ckan = fake.FakeCKAN()
+    data = generate(ckan, students, items, seed=seed)
+    ckan.latency = latency
+    ckan.measure = True
+    previous = client.install(ckan)
+    backend, cache.backend = cache.backend, LocMemCache('benchmark', {})
+    shared, index._shared = index._shared, None
+    enabled, replica.ENABLED = replica.ENABLED, False
+    users = []
+    try:
+        users.append(User.objects.create(username='benchmark-recruiter',
+                                         first_name=data['recruiter']))
+        users.append(User.objects.create(username='benchmark-student',
+                                         first_name=data['students'][0]))
+        data.update(factory=RequestFactory(), viewer=users[0],
+                    profile=users[1].username)
+        # portfolio is linked as after backfill_portfolios
+        production.User(data['students'][0]).student_portfolio()
+        yield data
+    finally:
+        PortfolioLink.objects.filter(user_id__in=data['students']).delete()
+        for user in users:
+            user.delete()
+        replica.ENABLED = enabled
+        index._shared = shared
+        cache.backend = backend
+        client.install(previous)
+
+
+def load_budgets(path=BUDGETS):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_budgets(results, path=BUDGETS):
+    with open(path, 'w') as f:
+        json.dump({result.scenario: result.calls for result in results},
+                  f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+@scenario('search')
+def search_students(data):
+    production.Search(use_index=False).students(data['tags'][:2])
+
+
+@scenario('search_ranked')
+def search_ranked(data):
+    production.Search(use_index=False).students(data['tags'][:3],
+                                                 ranked=True, weighted=True)
+
+
+@scenario('search_pages')
+def search_pages(data):
+    search = production.Search(use_index=False)
+    cursor = None
+    for _ in range(5):
+        cursor = search.students(data['tags'][:1], cursor=cursor)['next']
+
+
+@scenario('portfolio_reload')
+def portfolio_reload(data):
+    production.User(data['students'][0]).student_portfolio().reload()
+
+
+@scenario('user_universities')
+def user_universities(data):
+    list(production.User(data['students'][0]).universities())
+
+
+@scenario('show_profile')
+def show_profile(data):
+    request = data['factory'].get('/profile/')
+    request.user = data['viewer']
+    profile_views.show_profile(request, data['profile'])
+
+
+@scenario('search_view')
+def search_view(data):
+    request = data['factory'].get('/search/', {
+        'selected_tags': data['tags'][:2]})
+    request.user = data['viewer']
+    search_views.search(request)
@@ -0,0 +1,99 @@
+import functools
+import time
+
+from django.conf import settings
+from django.core.cache import cache as backend
+
+from . import policy
+
+# seconds for which cached results are fresh
+TTL = getattr(settings, 'CKAN_CACHE_TTL', {'tags_list': 300,
+                                           'top_tags': 300,
+                                           'university_list': 600})
+# stale results are kept so only one caller reloads expired value
+STALE_TTL = getattr(settings, 'CKAN_CACHE_STALE_TTL', 3600)
+# seconds reserved for reload of one value
+LOCK_TTL = 30
+PREFIX = 'ckan_model:'
+
+
+def _version(name):
+    return backend.get(PREFIX + name + ':version', 0)
+
+
+def _key(name, args):
+    return '{}{}:{}:{}'.format(PREFIX, name, _version(name),
+                               ':'.join(str(arg) for arg in args))
+
+
+def get(name, args, load, ttl=None):
+    """Get value from cache or load it. Expired value is reloaded by
+    one caller only, others get previous value meanwhile. When nothing
+    is cached, callers wait for the one loading value. When reload
+    fails because CKAN is unavailable, expired value is returned.
+
+    :param name: name of cached data, used for invalidate
+    :param args: arguments, which are part of key
+    :param load: function which loads value
+    :param ttl: seconds for which value is fresh, default from TTL
+    :return: cached or loaded value
+    """
+    if ttl is None:
+        ttl = TTL.get(name, 300)
+    key = _key(name, args)
+    deadline = time.time() + LOCK_TTL
+    while True:
+        entry = backend.get(key)
+        if entry is not None and time.time() < entry[1]:
+            return entry[0]
+        if backend.add(key + ':lock', 1, LOCK_TTL):
+            # value may have been loaded while we waited for lock
+            loaded = backend.get(key)
+            if loaded is not None and time.time() < loaded[1]:
+                backend.delete(key + ':lock')
+                return loaded[0]
+            entry = loaded or entry
+            break
+        if entry is not None:
+            return entry[0]  # stale value while other caller reloads it
+        if time.time() > deadline:
+            return load()
+        time.sleep(0.05)
+
+    try:
+        try:
+            value = load()
+        except Exception as e:
+            if entry is not None and policy.is_failure(e):
+                return entry[0]  # CKAN is unhealthy, serve what we have
+            raise
+        backend.set(key, (value, time.time() + ttl), ttl + STALE_TTL)
+        return value
+    finally:
+        backend.delete(key + ':lock')
+
+
+def invalidate(*names):
+    """Forget all cached values of names, after data was changed.
+
+    :param names: names of cached data
+    """
+    for name in names:
+        try:
+            backend.incr(PREFIX + name + ':version')
+        except ValueError:
+            backend.set(PREFIX + name + ':version', 1, None)
+
+
+def cached(name):
+    """Decorator of methods which results are cached under name.
+    Arguments of method (also keyword ones) are part of key.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = args + tuple('{}={}'.format(*item)
+                               for item in sorted(kwargs.items()))
+            return get(name, key, lambda: method(self, *args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,171 @@
+import copy
+import json
+import threading
+import time
+
+import ckanapi
+import ckanapi.common
+import requests
+import requests.adapters
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics, policy
+
+CKAN_URL = getattr(settings, 'CKAN_URL', "http://ckan.local")
+SYSADMIN_APIKEY = getattr(settings, 'CKAN_SYSADMIN_APIKEY',
+                          "cd609119-9305-48bb-8b9c-5b3083252d80")
+# dotted path of class used instead of CKAN at CKAN_URL (e.g. fake CKAN)
+BACKEND = getattr(settings, 'CKAN_BACKEND', None)
+# keep-alive connections kept open to every CKAN host
+POOL_SIZE = getattr(settings, 'CKAN_POOL_SIZE', 10)
+# identical reads made at same time share one call
+COALESCE = getattr(settings, 'CKAN_COALESCE', True)
+
+_lock = threading.Lock()
+_local = threading.local()
+_remote = None
+_flights = {}  # key of read in progress -> _Flight
+
+
+def measured(size):
+    """Record size of response of current CKAN call, for metrics.
+
+    :param size: bytes
+    """
+    _local.size = size
+
+
+def _measure(response, *args, **kwargs):
+    measured(len(response.content))
+
+
+def remote():
+    """Get process-wide RemoteCKAN. All clients share it together with
+    its HTTP session, so TCP connections to CKAN are kept alive and
+    reused between API calls and between requests.
+
+    :return: ckanapi.RemoteCKAN or backend set by CKAN_BACKEND
+    """
+    global _remote
+    if _remote is None:
+        with _lock:
+            if _remote is None:
+                if BACKEND is not None:
+                    _remote = import_string(BACKEND)()
+                    return _remote
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=POOL_SIZE,
+                    pool_maxsize=POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.hooks['response'].append(_measure)
+                _remote = ckanapi.RemoteCKAN(CKAN_URL, session=session)
+    return _remote
+
+
+def install(backend):
+    """Replace CKAN used by all clients, e.g. by fake.FakeCKAN in tests.
+
+    :param backend: object with call_action as ckanapi.RemoteCKAN,
+                    None for CKAN at CKAN_URL
+    :return: previously used backend
+    """
+    global _remote
+    with _lock:
+        previous, _remote = _remote, backend
+    return previous
+
+
+class Client:
+    def __init__(self, apikey=None):
+        """CKAN API bound to one user. Client is cheap to create,
+        it only remembers API key which is sent with every call
+        through shared connection pool. Interface is same as
+        ckanapi.RemoteCKAN (call_action and action shortcut).
+
+        When several threads make same read (action, parameters and
+        API key) at once, only first one calls CKAN and others get
+        copy of its result.
+
+        :param apikey: API key of user, None for anonymous access
+        """
+        self.apikey = apikey
+        self.action = ckanapi.common.ActionShortcut(self)
+
+    def call_action(self, action, data_dict=None, context=None, files=None):
+        if not COALESCE or files or not policy.is_idempotent(action):
+            return self._call(action, data_dict, context, files)
+
+        key = _flight_key(action, data_dict, self.apikey)
+        with _lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = _Flight()
+            else:
+                flight.followers += 1
+        if not leader:
+            if not flight.done.wait(policy.remaining()):
+                raise policy.DeadlineExceeded(action)
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+
+        try:
+            flight.result = self._call(action, data_dict, context, files)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with _lock:
+                del _flights[key]
+            flight.done.set()
+        # followers copy result, so caller may change it
+        return (copy.deepcopy(flight.result) if flight.followers
+                else flight.result)
+
+    def _call(self, action, data_dict, context, files):
+        def attempt(timeout):
+            _local.size = None
+            begin = time.time()
+            error = None
+            try:
+                return remote().call_action(
+                    action, data_dict,
+                    context=context,
+                    apikey=self.apikey,
+                    files=files,
+                    requests_kwargs={'timeout': timeout})
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                metrics.record(action, time.time() - begin, _local.size,
+                               error)
+
+        return policy.call(action, attempt)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+
+def _flight_key(action, data_dict, apikey):
+    return (action,
+            json.dumps(data_dict or {}, sort_keys=True, default=str),
+            apikey)
+
+
+def connect(apikey=None):
+    """Get CKAN client for user.
+
+    :param apikey: API key of user, None for anonymous access
+    :return: Client
+    """
+    return Client(apikey)
@@ -0,0 +1,74 @@
+import base64
+import json
+
+
+def encode(state):
+    """Make opaque cursor from dictionary.
+
+    :param state: dictionary with JSON serializable values
+    :return: URL safe string
+    """
+    data = json.dumps(state, separators=(',', ':'), sort_keys=True)
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode(cursor, key=str, limit=None):
+    """Get dictionary back from cursor. Cursor comes from client, so
+    only checked values are returned.
+
+    :param cursor: string from encode
+    :param key: type of sort key in after or before, str or int
+    :param limit: integer sort key must be lower than limit
+    :return: dictionary with keys position, total and after or before
+    :raise ValueError: malformed cursor
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        state = json.loads(data.decode())
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(state, dict) or \
+            ('after' in state) == ('before' in state):
+        raise ValueError('Invalid cursor')
+    direction = 'after' if 'after' in state else 'before'
+    res = {'position': _number(state.get('position')),
+           'total': _number(state.get('total'))}
+    if res['position'] > res['total']:
+        raise ValueError('Invalid cursor')
+    if key is int:
+        res[direction] = _number(state[direction], limit)
+    elif isinstance(state[direction], key):
+        res[direction] = state[direction]
+    else:
+        raise ValueError('Invalid cursor')
+    return res
+
+
+def _number(value, limit=None):
+    if type(value) is not int or value < 0 or \
+            (limit is not None and value >= limit):
+        raise ValueError('Invalid cursor')
+    return value
+
+
+def page(first, last, start, count, rows, total):
+    """Cursors for neighbouring pages of result.
+
+    :param first: sort key of first result on page
+    :param last: sort key of last result on page
+    :param start: position of first result on page
+    :param count: number of results on page
+    :param rows: page size
+    :param total: number of all results
+    :return: tuple (previous, next), None when page doesn't exist
+    """
+    prev = next = None
+    if count and start > 0:
+        prev = encode({'before': first,
+                       'position': max(0, start - rows),
+                       'total': total})
+    if count and start + count < total:
+        next = encode({'after': last,
+                       'position': start + count,
+                       'total': total})
+    return prev, next
@@ -0,0 +1,759 @@
+import collections
+import copy
+import datetime
+import heapq
+import json
+import math
+import re
+import threading
+import time
+import uuid
+
+import ckanapi
+
+from .client import SYSADMIN_APIKEY, measured
+
+NAME = re.compile(r'^[a-z0-9_-]{2,100}$')
+NAME_ERROR = 'Must be purely lowercase alphanumeric (ascii) characters ' \
+             'and these symbols: -_'
+# package fields answerable by exact match from search index
+INDEXED = ('id', 'name', 'title', 'author', 'creator_user_id', 'owner_org',
+           'organization', 'groups', 'tags', 'type', 'state')
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat()
+
+
+class FakeCKAN:
+    def __init__(self, sysadmin_apikey=SYSADMIN_APIKEY, latency=0.0,
+                 measure=False):
+        """CKAN kept in memory of this process. It implements actions
+        used by ckan_model with same results and errors as CKAN,
+        including permissions of users and Solr queries made by
+        ckan_model (fields, OR, AND, NOT, ranges, boosts, sort and
+        facets). Interface is same as ckanapi.RemoteCKAN, so it can
+        replace it in client.install.
+
+        New CKAN contains sysadmin and groups students and
+        students-work, which ckan_model expects to exist.
+
+        :param sysadmin_apikey: API key of sysadmin
+        :param latency: seconds added to every call, as network and
+                        CKAN itself would take
+        :param measure: serialize responses as CKAN API does and report
+                        their size (client.measured)
+        """
+        self.latency = latency
+        self.measure = measure
+        # ckan.group_and_organization_list_all_fields_max and _max
+        self.list_all_fields_max = 25
+        self.list_max = 1000
+        self._lock = threading.RLock()
+        self.users = {}  # id -> user
+        self.packages = {}  # id -> package
+        self.organizations = {}  # id -> organization
+        self.groups = {}  # id -> group
+        # group or organization id -> {user id: capacity}
+        self.members = collections.defaultdict(dict)
+        self._names = {'user': {}, 'package': {}, 'organization': {},
+                       'group': {}}  # kind -> name -> id
+        self._apikeys = {}  # API key -> user id
+        # field -> value -> set of ids of active packages
+        self._index = {field: collections.defaultdict(set)
+                       for field in INDEXED}
+
+        self.sysadmin = self._add_user({'name': 'admin', 'sysadmin': True},
+                                       sysadmin_apikey)
+        for name in ('students', 'students-work'):
+            self._add_group({'name': name, 'title': name},
+                            self.sysadmin, 'group')
+
+    def call_action(self, action, data_dict=None, context=None, apikey=None,
+                    files=None, requests_kwargs=None):
+        """Call CKAN action as ckanapi.RemoteCKAN does.
+
+        :raise ckanapi.NotFound:
+        :raise ckanapi.NotAuthorized:
+        :raise ckanapi.ValidationError:
+        :raise ckanapi.CKANAPIError: unknown action
+        """
+        method = getattr(self, 'action_' + action, None)
+        if method is None:
+            raise ckanapi.CKANAPIError(
+                'Bad request - Action name not known: {}'.format(action))
+        if self.latency:
+            time.sleep(self.latency)
+        user = self.users.get(self._apikeys.get(apikey))
+        with self._lock:
+            res = method(dict(data_dict or {}), user, files or {})
+            if self.measure:
+                body = json.dumps({'success': True, 'result': res})
+                measured(len(body))
+                return json.loads(body)['result']
+            return copy.deepcopy(res)
+
+    def bulk(self, calls):
+        """Make many calls at once, to fill CKAN with large synthetic
+        data quickly. Results are neither copied nor measured and
+        latency isn't added, so they must not be changed by caller.
+
+        :param calls: iterable of tuples (action, data_dict, apikey)
+        :return: list of results
+        :raise: as call_action
+        """
+        with self._lock:
+            return [getattr(self, 'action_' + action)(
+                dict(data), self.users.get(self._apikeys.get(apikey)), {})
+                for action, data, apikey in calls]
+
+    # users
+
+    def _add_user(self, data, apikey=None):
+        user = {'id': str(uuid.uuid4()),
+                'name': data['name'],
+                'fullname': data.get('fullname'),
+                'display_name': data.get('fullname') or data['name'],
+                'about': data.get('about'),
+                'email': data.get('email'),
+                'apikey': apikey or str(uuid.uuid4()),
+                'sysadmin': data.get('sysadmin', False),
+                'state': 'active',
+                'created': _now()}
+        self.users[user['id']] = user
+        self._names['user'][user['name']] = user['id']
+        self._apikeys[user['apikey']] = user['id']
+        return user
+
+    def _get(self, kind, id):
+        """Object of kind ('user', 'package', 'organization', 'group')
+        by id or name.
+        """
+        objects = {'user': self.users,
+                   'package': self.packages,
+                   'organization': self.organizations,
+                   'group': self.groups}[kind]
+        if id not in objects:
+            id = self._names[kind].get(id)
+        if id is None:
+            raise ckanapi.NotFound('{} not found'.format(kind.capitalize()))
+        return objects[id]
+
+    @staticmethod
+    def _check_name(name, taken, error):
+        if not isinstance(name, str) or not NAME.match(name):
+            raise ckanapi.ValidationError({'name': [NAME_ERROR]})
+        if name in taken:
+            raise ckanapi.ValidationError({'name': [error]})
+
+    @staticmethod
+    def _user_dict(user, caller):
+        res = dict(user)
+        if caller is None or (caller['id'] != user['id'] and
+                              not caller['sysadmin']):
+            del res['apikey'], res['email']
+        return res
+
+    def action_user_create(self, data, caller, files):
+        self._check_name(data.get('name'), self._names['user'],
+                         'That login name is not available.')
+        if not data.get('email'):
+            raise ckanapi.ValidationError({'email': ['Missing value']})
+        user = self._add_user(data)
+        return self._user_dict(user, user)
+
+    def action_user_show(self, data, caller, files):
+        return self._user_dict(self._get('user', data.get('id')), caller)
+
+    def action_user_update(self, data, caller, files):
+        user = self._get('user', data.get('id'))
+        if caller is None or (caller['id'] != user['id'] and
+                              not caller['sysadmin']):
+            raise ckanapi.NotAuthorized(
+                'User {} not authorized to edit user'.format(
+                    caller and caller['name']))
+        for key in ('fullname', 'about', 'email'):
+            if key in data:
+                user[key] = data[key]
+        user['display_name'] = user['fullname'] or user['name']
+        return self._user_dict(user, caller)
+
+    def action_user_delete(self, data, caller, files):
+        user = self._get('user', data.get('id'))
+        self._require_sysadmin(caller)
+        user['state'] = 'deleted'
+
+    @staticmethod
+    def _require_sysadmin(caller):
+        if caller is None or not caller['sysadmin']:
+            raise ckanapi.NotAuthorized('Only sysadmins can do this')
+
+    # organizations and groups
+
+    def _add_group(self, data, creator, kind):
+        group = {'id': str(uuid.uuid4()),
+                 'name': data['name'],
+                 'title': data.get('title') or data['name'],
+                 'display_name': data.get('title') or data['name'],
+                 'description': data.get('description') or '',
+                 'image_url': data.get('image_url') or '',
+                 'image_display_url': data.get('image_url') or '',
+                 'extras': list(data.get('extras') or []),
+                 'type': kind,
+                 'is_organization': kind == 'organization',
+                 'approval_status': 'approved',
+                 'state': 'active',
+                 'created': _now()}
+        if kind == 'organization':
+            self.organizations[group['id']] = group
+        else:
+            self.groups[group['id']] = group
+        self._names[kind][group['name']] = group['id']
+        self.members[group['id']][creator['id']] = 'admin'
+        return group
+
+    def _org_dict(self, org, extras=True):
+        res = dict(org)
+        res['package_count'] = len(self._index['owner_org'].get(org['id'],
+                                                                ()))
+        if not extras:
+            del res['extras']
+        return res
+
+    def _require_admin(self, group, caller, capacities=('admin',)):
+        if caller is None or not (
+                caller['sysadmin'] or
+                self.members[group['id']].get(caller['id']) in capacities):
+            raise ckanapi.NotAuthorized(
+                'User {} not authorized to edit group {}'.format(
+                    caller and caller['name'], group['name']))
+
+    def action_organization_create(self, data, caller, files):
+        if caller is None:
+            raise ckanapi.NotAuthorized('Anonymous can not create group')
+        self._check_name(data.get('name'), self._names['organization'],
+                         'Group name already exists in database')
+        return self._org_dict(self._add_group(data, caller, 'organization'))
+
+    def action_organization_show(self, data, caller, files):
+        org = self._get('organization', data.get('id'))
+        res = self._org_dict(org)
+        if data.get('include_users', True):
+            members = self.members[org['id']]
+            res['users'] = [{'id': id, 'name': self.users[id]['name'],
+                             'capacity': capacity}
+                            for id, capacity in members.items()]
+        return res
+
+    def action_organization_list(self, data, caller, files):
+        orgs = sorted((org for org in self.organizations.values()
+                       if org['state'] == 'active'),
+                      key=lambda org: org['name'])
+        if data.get('organizations'):
+            names = set(data['organizations'])
+            orgs = [org for org in orgs if org['name'] in names]
+        offset = int(data.get('offset') or 0)
+        limit = self.list_all_fields_max if data.get('all_fields') \
+            else self.list_max
+        if data.get('limit') is not None:
+            limit = min(limit, int(data['limit']))
+        orgs = orgs[offset:offset + limit]
+        if not data.get('all_fields'):
+            return [org['name'] for org in orgs]
+        return [self._org_dict(org, data.get('include_extras', False))
+                for org in orgs]
+
+    def action_organization_list_for_user(self, data, caller, files):
+        if caller is None:
+            return []
+        capacities = {'read': ('member', 'editor', 'admin'),
+                      'create_dataset': ('editor', 'admin'),
+                      'update_dataset': ('editor', 'admin'),
+                      }.get(data.get('permission', 'manage_group'),
+                            ('admin',))
+        res = []
+        for org in sorted(self.organizations.values(),
+                          key=lambda org: org['name']):
+            capacity = self.members[org['id']].get(caller['id'])
+            if caller['sysadmin'] or capacity in capacities:
+                org = self._org_dict(org, extras=False)
+                org['capacity'] = capacity or 'admin'
+                res.append(org)
+        return res
+
+    def action_organization_patch(self, data, caller, files):
+        org = self._get('organization', data.pop('id', None))
+        self._require_admin(org, caller)
+        if 'name' in data and data['name'] != org['name']:
+            self._check_name(data['name'], self._names['organization'],
+                             'Group name already exists in database')
+            del self._names['organization'][org['name']]
+            self._names['organization'][data['name']] = org['id']
+        upload = data.pop('image_upload', None) or files.get('image_upload')
+        if upload is not None:
+            data['image_url'] = getattr(upload, 'name', 'upload')
+        for key in ('name', 'title', 'description', 'image_url', 'extras'):
+            if key in data:
+                org[key] = data[key]
+        org['display_name'] = org['title'] or org['name']
+        org['image_display_url'] = org['image_url']
+        return self._org_dict(org)
+
+    def action_organization_member_create(self, data, caller, files):
+        org = self._get('organization', data.get('id'))
+        user = self._get('user', data.get('username'))
+        self._require_admin(org, caller)
+        self.members[org['id']][user['id']] = data.get('role', 'member')
+        return {'group_id': org['id'], 'table_id': user['id'],
+                'capacity': data.get('role', 'member')}
+
+    def action_group_member_create(self, data, caller, files):
+        group = self._get('group', data.get('id'))
+        user = self._get('user', data.get('username'))
+        self._require_admin(group, caller)
+        self.members[group['id']][user['id']] = data.get('role', 'member')
+        return {'group_id': group['id'], 'table_id': user['id'],
+                'capacity': data.get('role', 'member')}
+
+    # packages
+
+    def _index_values(self, package):
+        return {'id': [package['id']],
+                'name': [package['name']],
+                'title': [package['title']],
+                'author': [package['author']],
+                'creator_user_id': [package['creator_user_id']],
+                'owner_org': [package['owner_org']],
+                'organization': [package['organization']['name']],
+                'groups': [group['name'] for group in package['groups']],
+                'tags': [tag['name'] for tag in package['tags']],
+                'type': [package['type']],
+                'state': [package['state']]}
+
+    def _unindex(self, package):
+        for field, values in self._index_values(package).items():
+            postings = self._index[field]
+            for value in values:
+                ids = postings.get(value)
+                if ids is not None:
+                    ids.discard(package['id'])
+                    if not ids:
+                        del postings[value]
+
+    def _reindex(self, package):
+        if package['state'] != 'active':
+            return
+        for field, values in self._index_values(package).items():
+            for value in values:
+                self._index[field][value].add(package['id'])
+
+    def _set_package(self, package, data, caller):
+        """Validate data and change package by them.
+        """
+        if 'owner_org' in data:
+            try:
+                org = self._get('organization', data['owner_org'])
+            except ckanapi.NotFound:
+                raise ckanapi.ValidationError(
+                    {'owner_org': ['Organization does not exist']})
+            self._require_admin(org, caller, ('editor', 'admin'))
+            package['owner_org'] = org['id']
+            package['organization'] = self._org_dict(org, extras=False)
+        if 'groups' in data:
+            groups = []
+            for group in data['groups'] or []:
+                try:
+                    group = self._get('group', group.get('id') or
+                                      group.get('name'))
+                except ckanapi.NotFound:
+                    raise ckanapi.ValidationError(
+                        {'groups': ['Group does not exist']})
+                if group['name'] not in [g['name'] for g in
+                                         package.get('groups', [])]:
+                    self._require_admin(group, caller,
+                                        ('member', 'editor', 'admin'))
+                groups.append({'id': group['id'], 'name': group['name'],
+                               'title': group['title'],
+                               'display_name': group['display_name']})
+            package['groups'] = groups
+        if 'tags' in data:
+            names = sorted({tag['name'] for tag in data['tags'] or []})
+            for name in names:
+                if not 2 <= len(name) <= 100 or \
+                        not re.match(r'^[\w .-]+$', name):
+                    raise ckanapi.ValidationError({'tags': [
+                        'Tag "{}" must be alphanumeric characters or '
+                        'symbols: -_.'.format(name)]})
+            package['tags'] = [{'name': name, 'display_name': name,
+                                'state': 'active'} for name in names]
+            package['num_tags'] = len(names)
+        if 'extras' in data:
+            package['extras'] = [{'key': extra['key'],
+                                  'value': extra['value']}
+                                 for extra in data['extras'] or []]
+        for key in ('title', 'author', 'author_email', 'notes', 'url',
+                    'version', 'private'):
+            if key in data:
+                package[key] = data[key]
+        package['metadata_modified'] = _now()
+
+    def action_package_create(self, data, caller, files):
+        if caller is None:
+            raise ckanapi.NotAuthorized('Anonymous can not create dataset')
+        self._check_name(data.get('name'), self._names['package'],
+                         'That URL is already in use.')
+        if not data.get('owner_org'):
+            raise ckanapi.ValidationError({'owner_org': ['Missing value']})
+        now = _now()
+        package = {'id': str(uuid.uuid4()),
+                   'name': data['name'],
+                   'title': data.get('title') or data['name'],
+                   'author': None, 'author_email': None,
+                   'notes': None, 'url': None, 'version': None,
+                   'private': False, 'type': 'dataset', 'state': 'active',
+                   'creator_user_id': caller['id'],
+                   'groups': [], 'tags': [], 'num_tags': 0, 'extras': [],
+                   'resources': [], 'num_resources': 0,
+                   'metadata_created': now}
+        self._set_package(package, dict({'groups': [], 'tags': []}, **data),
+                          caller)
+        self.packages[package['id']] = package
+        self._names['package'][package['name']] = package['id']
+        self._reindex(package)
+        return package
+
+    def action_package_show(self, data, caller, files):
+        return self._get('package', data.get('id'))
+
+    def action_package_patch(self, data, caller, files):
+        package = self._get('package', data.pop('id', None))
+        org = self.organizations[package['owner_org']]
+        self._require_admin(org, caller, ('editor', 'admin'))
+        if 'name' in data and data['name'] != package['name']:
+            self._check_name(data['name'], self._names['package'],
+                             'That URL is already in use.')
+            del self._names['package'][package['name']]
+            self._names['package'][data['name']] = package['id']
+        self._unindex(package)
+        try:
+            if 'name' in data:
+                package['name'] = data['name']
+            self._set_package(package, data, caller)
+        finally:
+            self._reindex(package)
+        return package
+
+    def action_package_delete(self, data, caller, files):
+        package = self._get('package', data.get('id'))
+        org = self.organizations[package['owner_org']]
+        self._require_admin(org, caller, ('editor', 'admin'))
+        self._unindex(package)
+        package['state'] = 'deleted'
+        package['metadata_modified'] = _now()
+
+    def action_resource_create(self, data, caller, files):
+        package = self._get('package', data.get('package_id'))
+        org = self.organizations[package['owner_org']]
+        self._require_admin(org, caller, ('editor', 'admin'))
+        upload = files.get('upload')
+        resource = {'id': str(uuid.uuid4()),
+                    'package_id': package['id'],
+                    'name': data.get('name'),
+                    'description': data.get('description'),
+                    'url': getattr(upload, 'name', None) or data.get('url'),
+                    'url_type': 'upload' if upload is not None else None,
+                    'format': data.get('format', ''),
+                    'created': _now()}
+        package['resources'].append(resource)
+        package['num_resources'] = len(package['resources'])
+        package['metadata_modified'] = _now()
+        return resource
+
+    def action_tag_list(self, data, caller, files):
+        return sorted(self._index['tags'])
+
+    def action_status_show(self, data, caller, files):
+        return {'site_title': 'Fake CKAN', 'ckan_version': '2.5.0',
+                'extensions': []}
+
+    # search
+
+    def action_package_search(self, data, caller, files):
+        q = data.get('q') or '*:*'
+        fq = data.get('fq') or '*:*'
+        query = ('and', [_parse(q), _parse(fq)])
+        sets = {}
+        ids = self._match(query, sets)
+        count = len(ids)
+
+        sort = [part.split() for part in
+                (data.get('sort') or 'score desc, metadata_modified desc')
+                .split(',')]
+        start = int(data.get('start') or 0)
+        rows = int(data.get('rows') if data.get('rows') is not None else 10)
+
+        def key(doc):
+            package = self.packages[doc]
+            return _SortKey([
+                (self._score(query, doc, sets, count) if field == 'score'
+                 else package.get(field) or '', direction == 'desc')
+                for field, direction in sort])
+
+        page = heapq.nsmallest(start + rows, ids, key=key)[start:]
+        fields = data.get('fl')
+        if isinstance(fields, str):
+            fields = fields.replace(',', ' ').split()
+        if fields:
+            results = [{field: _stored(self.packages[doc], field)
+                        for field in fields} for doc in page]
+        else:
+            results = [self.packages[doc] for doc in page]
+
+        facets = {}
+        search_facets = {}
+        facet_fields = data.get('facet.field') or []
+        if isinstance(facet_fields, str):
+            facet_fields = json.loads(facet_fields)
+        limit = int(data.get('facet.limit') or 50)
+        for field in facet_fields:
+            counts = collections.Counter(
+                value for doc in ids
+                for value in self._index_values(self.packages[doc])
+                .get(field, ()))
+            counts = counts.most_common(None if limit < 0 else limit)
+            facets[field] = dict(counts)
+            search_facets[field] = {'title': field, 'items': [
+                {'name': name, 'display_name': name, 'count': n}
+                for name, n in counts]}
+        return {'count': count,
+                'sort': data.get('sort'),
+                'results': results,
+                'facets': facets,
+                'search_facets': search_facets}
+
+    def _postings(self, field, value):
+        if field == '*' or field not in self._index:
+            if field == '*' and value == '*':
+                return self._index['state'].get('active', set())
+            return set()
+        if value == '*':
+            return set().union(*self._index[field].values())
+        return self._index[field].get(value, set())
+
+    def _match(self, node, sets):
+        """Set of ids of packages matched by parsed query. Results
+        of subqueries are kept in sets for scoring.
+        """
+        kind = node[0]
+        if kind == 'term' and node[1] == 'text' and node[2] != '*':
+            text = node[2].lower()
+            res = {doc for doc in self._postings('*', '*')
+                   if any(text in (value or '').lower() for value in
+                          _stored(self.packages[doc], 'tags') +
+                          [self.packages[doc][field]
+                           for field in ('name', 'title', 'notes')])}
+        elif kind == 'term':
+            res = self._postings(node[1], node[2])
+        elif kind == 'range':
+            field, low, high, low_incl, high_incl = node[1:]
+            res = set()
+            for doc in self._postings('*', '*'):
+                value = self.packages[doc].get(field)
+                if value is None:
+                    continue
+                if low is not None and (value < low or
+                                        not low_incl and value == low):
+                    continue
+                if high is not None and (value > high or
+                                         not high_incl and value == high):
+                    continue
+                res.add(doc)
+        elif kind == 'not':
+            res = self._postings('*', '*') - self._match(node[1], sets)
+        elif kind == 'and':
+            res = None
+            for child in node[1]:
+                if child[0] == 'not':
+                    matched = self._postings('*', '*') if res is None \
+                        else res
+                    res = matched - self._match(child[1], sets)
+                else:
+                    matched = self._match(child, sets)
+                    res = set(matched) if res is None else res & matched
+            res = res or set()
+        else:  # or
+            res = set()
+            for child in node[1]:
+                res |= self._match(child, sets)
+        sets[id(node)] = res
+        return res
+
+    def _score(self, node, doc, sets, total):
+        """Score of matched package as Solr computes it for queries
+        made by ckan_model: constant for boost ^=, otherwise idf.
+        """
+        if doc not in sets.get(id(node), ()):
+            return 0.0
+        kind = node[0]
+        if kind == 'term':
+            constant, boost = node[3]
+            if constant:
+                return boost
+            df = len(sets[id(node)])
+            return boost * (1 + math.log(max(total, 1) / (df + 1)))
+        if kind in ('and', 'or'):
+            return sum(self._score(child, doc, sets, total)
+                       for child in node[1])
+        return 0.0
+
+
+class _SortKey:
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __lt__(self, other):
+        for (a, desc), (b, _) in zip(self.values, other.values):
+            if a != b:
+                return a > b if desc else a < b
+        return False
+
+
+def _stored(package, field):
+    """Field as stored in Solr, returned when fl is used.
+    """
+    if field == 'tags':
+        return [tag['name'] for tag in package['tags']]
+    if field == 'groups':
+        return [group['name'] for group in package['groups']]
+    if field == 'organization':
+        return package['organization']['name']
+    return package.get(field)
+
+
+_TOKEN = re.compile(r'''\s*(?:
+    (?P<open>\() |
+    (?P<close>\)) |
+    (?P<op>AND|OR|NOT|&&|\|\|)(?=[\s("]) |
+    (?P<field>[\w.]+|\*):
+        (?P<range>(?P<lb>[\[{])\s*(?P<low>"(?:[^"\\]|\\.)*"|\S+?)\s+TO\s+
+         (?P<high>"(?:[^"\\]|\\.)*"|[^\]}\s]+)\s*(?P<rb>[\]}]))? |
+    (?P<phrase>"(?:[^"\\]|\\.)*") |
+    (?P<boost>\^(?P<constant>=)?(?P<value>[\d.]+)) |
+    (?P<word>[^\s()":^]+)
+    )''', re.X)
+
+
+def _tokenize(query):
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        match = _TOKEN.match(query, pos)
+        if match is None or match.end() == pos:
+            raise ckanapi.SearchQueryError(
+                'Can not parse query: {}'.format(query))
+        pos = match.end()
+        yield match
+
+
+def _value(text):
+    if text.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', text[1:-1])
+    return text
+
+
+def _parse(query):
+    """Parse Solr query into tree of tuples:
+    ('term', field, value, (constant, boost)),
+    ('range', field, low, high, low inclusive, high inclusive),
+    ('and', [nodes]), ('or', [nodes]), ('not', node)
+    """
+    tokens = list(_tokenize(query))
+    node, pos = _expr(tokens, 0, 'text')
+    if pos != len(tokens):
+        raise ckanapi.SearchQueryError('Can not parse query: ' + query)
+    return node
+
+
+def _expr(tokens, pos, field):
+    """expr := conjunction (OR conjunction)*
+    conjunction := unary ((AND)? unary)*
+    Terms without operator are joined by OR as in Solr.
+    """
+    alternatives = []
+    terms = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token.group('close'):
+            break
+        if token.group('op') in ('OR', '||'):
+            alternatives.append(terms)
+            terms = []
+            pos += 1
+            continue
+        if token.group('op') in ('AND', '&&'):
+            pos += 1
+            node, pos = _unary(tokens, pos, field)
+            terms.append(node)
+            continue
+        node, pos = _unary(tokens, pos, field)
+        if terms:  # implicit OR
+            alternatives.append(terms)
+            terms = []
+        terms.append(node)
+    alternatives.append(terms)
+    nodes = [terms[0] if len(terms) == 1 else ('and', terms)
+             for terms in alternatives if terms]
+    if not nodes:
+        raise ckanapi.SearchQueryError('Empty query')
+    return (nodes[0] if len(nodes) == 1 else ('or', nodes)), pos
+
+
+def _unary(tokens, pos, field):
+    if pos >= len(tokens):
+        raise ckanapi.SearchQueryError('Unexpected end of query')
+    token = tokens[pos]
+    if token.group('op') == 'NOT':
+        node, pos = _unary(tokens, pos + 1, field)
+        return ('not', node), pos
+    if token.group('open'):
+        node, pos = _expr(tokens, pos + 1, field)
+        if pos >= len(tokens) or not tokens[pos].group('close'):
+            raise ckanapi.SearchQueryError('Missing )')
+        pos += 1
+    elif token.group('field'):
+        if token.group('range'):
+            low = _value(token.group('low'))
+            high = _value(token.group('high'))
+            if token.group('field').startswith('metadata_'):
+                # dates are stored without time zone
+                low, high = low.rstrip('Z'), high.rstrip('Z')
+            node = ('range', token.group('field'),
+                    None if low == '*' else low,
+                    None if high == '*' else high,
+                    token.group('lb') == '[', token.group('rb') == ']')
+            return node, pos + 1
+        return _unary(tokens, pos + 1, token.group('field'))
+    elif token.group('phrase') or token.group('word'):
+        node = ('term', field,
+                _value(token.group('phrase') or token.group('word')),
+                (False, 1.0))
+        pos += 1
+    else:
+        raise ckanapi.SearchQueryError('Unexpected ' + token.group(0))
+    if pos < len(tokens) and tokens[pos].group('boost'):
+        boost = tokens[pos]
+        node = _boost(node, bool(boost.group('constant')),
+                      float(boost.group('value')))
+        pos += 1
+    return node, pos
+
+
+def _boost(node, constant, value):
+    if node[0] == 'term':
+        return node[:3] + ((constant, value),)
+    if node[0] in ('and', 'or'):
+        return (node[0], [_boost(child, constant, value)
+                          for child in node[1]])
+    return node
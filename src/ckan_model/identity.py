@@ -0,0 +1,94 @@
+import contextlib
+import threading
+
+from . import parallel
+
+_local = threading.local()
+
+
+def start():
+    """Start identity map of current request. Until stop, every
+    loaded entity is remembered and loaded again only when forgotten.
+    """
+    _local.map = {}
+
+
+def stop():
+    """Drop identity map of current request.
+    """
+    _local.map = None
+
+
+@contextlib.contextmanager
+def scope():
+    """Identity map for code outside of request (e.g. commands).
+    """
+    previous = _get()
+    start()
+    try:
+        yield
+    finally:
+        _set(previous)
+
+
+def _get():
+    return getattr(_local, 'map', None)
+
+
+def _set(map):
+    _local.map = map
+
+
+# calls made in parallel.gather share map of request
+parallel.propagate(_get, _set)
+
+
+def load(kind, id, loader, keys=('id', 'name')):
+    """Get entity from identity map or load it.
+
+    :param kind: type of entity ('user', 'organization', 'package')
+    :param id: id or name of entity
+    :param loader: function without arguments loading entity
+    :param keys: keys of loaded dictionary under which it is remembered
+    :return: dictionary of entity
+    """
+    map = _get()
+    if map is None:
+        return loader()
+    value = map.get((kind, id))
+    if value is None:
+        value = loader()
+        store(kind, value, keys)
+        map[(kind, id)] = value
+    return value
+
+
+def store(kind, value, keys=('id', 'name')):
+    """Remember loaded or updated entity.
+
+    :param kind: type of entity
+    :param value: dictionary of entity
+    :param keys: keys of dictionary under which it is remembered
+    """
+    map = _get()
+    if map is None:
+        return
+    for key in keys:
+        if value.get(key) is not None:
+            map[(kind, value[key])] = value
+
+
+def forget(kind, id):
+    """Forget entity, next load goes to CKAN.
+
+    :param kind: type of entity
+    :param id: id or name of entity
+    """
+    map = _get()
+    if map is None:
+        return
+    value = map.pop((kind, id), None)
+    if value is not None:
+        for key, entity in list(map.items()):
+            if entity is value:
+                del map[key]
@@ -0,0 +1,329 @@
+import heapq
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from .client import connect
+from .cursor import page as page_cursors
+
+logger = logging.getLogger(__name__)
+
+# serve Search.students from in-process index instead of CKAN
+ENABLED = getattr(settings, 'CKAN_TAG_INDEX', False)
+# seconds between incremental refreshes of index
+REFRESH = getattr(settings, 'CKAN_TAG_INDEX_REFRESH', 30)
+# seconds between full rebuilds, which drop portfolios deleted in CKAN
+REBUILD = getattr(settings, 'CKAN_TAG_INDEX_REBUILD', 3600)
+# fields of portfolios loaded from search index
+FIELDS = ['id', 'name', 'title', 'tags', 'organization', 'metadata_modified']
+
+
+class TagIndex:
+    def __init__(self, ckan=None, refresh=REFRESH, rebuild=REBUILD):
+        """In-memory inverted index of student portfolios. Every
+        portfolio gets small document number, every tag and every
+        university a bitmap of document numbers. Bitmaps are python
+        integers, so filters are bitwise operations over whole index.
+
+        :param ckan: CKAN API used for loading portfolios
+        :param refresh: seconds between incremental refreshes,
+                        None disables automatic refresh
+        :param rebuild: seconds between automatic rebuilds,
+                        None disables them
+        """
+        self.ckan = connect() if ckan is None else ckan
+        self.refresh_interval = refresh
+        self.rebuild_interval = rebuild
+        self.inc = 1000  # results return at once from CKAN, maximum 1000
+        self.modified = None  # newest metadata_modified in index
+        self.refreshed = None  # time of last refresh
+        self.rebuilt = None  # time of last load of all portfolios
+        self.failed = None  # time of last failed refresh
+        self.thread = None  # thread of last refresh
+        self._lock = threading.RLock()
+        self._refreshing = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._docs = []  # document number -> student
+        self._numbers = {}  # package id -> document number
+        self._free = []  # document numbers of removed students
+        self._alive = 0
+        self._tags = {}
+        self._universities = {}
+
+    def students(self, tags=None, universities=None, start=0, rows=10,
+                 ranked=False, weighted=False, cursor=None):
+        """Same as Search.students, but answered from index.
+        Ranked search selects only top start+rows students by heap.
+        Cursors contain document numbers. Until index is loaded (see
+        ready), nothing is found.
+
+        :param cursor: decoded cursor
+        """
+        self._maybe_refresh()
+        tags = tags or []
+        universities = universities or []
+        ranked = ranked and bool(tags)
+        if cursor is not None:
+            start = cursor['position']
+        with self._lock:
+            mask = self._alive
+            if tags:
+                mask &= self._union(self._tags, tags)
+            if universities:
+                mask &= self._union(self._universities, universities)
+            total = popcount(mask)
+            if ranked:
+                weights = self._weights(tags, weighted)
+
+                def score(n):
+                    return (sum(weights.get(tag, 0)
+                                for tag in self._docs[n]['tags']), -n)
+
+                numbers = heapq.nlargest(start + rows, bits(mask),
+                                         key=score)[start:]
+            elif cursor is None:
+                numbers = list(bits(mask, start, start + rows))
+            elif 'after' in cursor:
+                mask &= ~((2 << cursor['after']) - 1)
+                numbers = list(bits(mask, 0, rows))
+            else:
+                mask &= (1 << cursor['before']) - 1
+                numbers = list(bits(mask))[-rows:]
+            results = [self._docs[n] for n in numbers]
+
+        prev = next = None
+        if not ranked and numbers:
+            prev, next = page_cursors(numbers[0], numbers[-1],
+                                      start, len(numbers), rows, total)
+        return {'total': total,
+                'start': start,
+                'results': [{
+                    'title': student['title'],
+                    'name': student['name'],
+                    'tags_matched': [tag for tag in student['tags']
+                                     if tag in tags],
+                    'tags_unmatched': [tag for tag in student['tags']
+                                       if tag not in tags],
+                } for student in results],
+                'prev': prev,
+                'next': next}
+
+    def ready(self):
+        """Tell if index was loaded, so it can answer searches. Loading
+        or refresh is started in background, when it is due.
+
+        :return: bool
+        """
+        self._maybe_refresh()
+        return self.refreshed is not None
+
+    @property
+    def size(self):
+        """Upper bound of document numbers, which cursors contain.
+        """
+        return len(self._docs)
+
+    def _weights(self, tags, weighted):
+        """Weight of every tag, 1 or its inverse document frequency.
+        """
+        if not weighted:
+            return {tag: 1 for tag in tags}
+        total = popcount(self._alive)
+        return {tag: math.log(1 + total /
+                              max(1, popcount(self._tags.get(tag, 0))))
+                for tag in tags}
+
+    def count(self, tag):
+        """Number of students with tag.
+        """
+        self._maybe_refresh()
+        with self._lock:
+            return popcount(self._tags.get(tag, 0))
+
+    @staticmethod
+    def _union(bitmaps, keys):
+        mask = 0
+        for key in keys:
+            mask |= bitmaps.get(key, 0)
+        return mask
+
+    def update(self, package):
+        """Add or replace student portfolio in index.
+
+        :param package: package dictionary from CKAN
+        """
+        # full package or fields from search index (FIELDS)
+        university = package.get('organization')
+        if isinstance(university, dict):
+            university = university['name']
+        student = {'id': package['id'],
+                   'name': package['name'],
+                   'title': package['title'],
+                   'tags': [tag['name'] if isinstance(tag, dict) else tag
+                            for tag in package['tags'] or []],
+                   'university': university}
+        with self._lock:
+            self.remove(student['id'])
+            n = self._free.pop() if self._free else len(self._docs)
+            if n == len(self._docs):
+                self._docs.append(student)
+            else:
+                self._docs[n] = student
+            self._numbers[student['id']] = n
+            bit = 1 << n
+            self._alive |= bit
+            for tag in student['tags']:
+                self._tags[tag] = self._tags.get(tag, 0) | bit
+            uni = student['university']
+            if uni is not None:
+                self._universities[uni] = self._universities.get(uni, 0) | bit
+
+    def remove(self, id):
+        """Remove student portfolio from index, if it is indexed.
+
+        :param id: package id
+        """
+        with self._lock:
+            n = self._numbers.pop(id, None)
+            if n is None:
+                return
+            student = self._docs[n]
+            bit = 1 << n
+            self._alive &= ~bit
+            for tag in student['tags']:
+                self._discard(self._tags, tag, bit)
+            if student['university'] is not None:
+                self._discard(self._universities, student['university'], bit)
+            self._docs[n] = None
+            self._free.append(n)
+
+    @staticmethod
+    def _discard(bitmaps, key, bit):
+        bitmap = bitmaps[key] & ~bit
+        if bitmap:
+            bitmaps[key] = bitmap
+        else:
+            del bitmaps[key]
+
+    def refresh(self):
+        """Load portfolios changed since last refresh from CKAN.
+        Portfolios which disappear from CKAN (deleted, moved out of group
+        students) aren't found by search of changes, so they are removed
+        only by rebuild, which runs every rebuild_interval seconds.
+        """
+        params = {'q': 'groups:students',
+                  'fl': ','.join(FIELDS),
+                  'sort': 'metadata_modified asc',
+                  'start': 0,
+                  'rows': self.inc}
+        if self.modified is not None:
+            params['fq'] = 'metadata_modified:[{}Z TO *]'.format(
+                self.modified)
+        while True:
+            res = self.ckan.call_action('package_search', params)
+            for package in res['results']:
+                self.update(package)
+                self.modified = max(self.modified or '',
+                                    package['metadata_modified'])
+            params['start'] += self.inc
+            if params['start'] >= res['count'] or not res['results']:
+                break
+        self.refreshed = time.time()
+        if self.rebuilt is None:
+            self.rebuilt = self.refreshed
+
+    def rebuild(self):
+        """Load all portfolios from CKAN into new index and replace
+        this one with it, so portfolios deleted in CKAN are dropped.
+        Searches are answered from current index while loading.
+        """
+        fresh = TagIndex(self.ckan, refresh=None, rebuild=None)
+        fresh.refresh()
+        with self._lock:
+            self._docs = fresh._docs
+            self._numbers = fresh._numbers
+            self._free = fresh._free
+            self._alive = fresh._alive
+            self._tags = fresh._tags
+            self._universities = fresh._universities
+            self.modified = fresh.modified
+            self.refreshed = self.rebuilt = fresh.refreshed
+
+    def _maybe_refresh(self):
+        """Start refresh, or rebuild when it is due, in background
+        thread. Searches don't wait for it (nor share deadline of their
+        request with it), they are answered from current index.
+        """
+        now = time.time()
+        if self.refreshed is not None and (
+                self.refresh_interval is None or
+                now - self.refreshed < self.refresh_interval):
+            return
+        if self.failed is not None and \
+                now - self.failed < (self.refresh_interval or REFRESH):
+            return  # don't retry failed load in every request
+        # only one thread refreshes
+        if not self._refreshing.acquire(blocking=False):
+            return
+        self.thread = threading.Thread(target=self._refresh_in_background,
+                                       daemon=True)
+        self.thread.start()
+
+    def _refresh_in_background(self):
+        try:
+            if self.rebuilt is None or (
+                    self.rebuild_interval is not None and
+                    time.time() - self.rebuilt >= self.rebuild_interval):
+                self.rebuild()
+            else:
+                self.refresh()
+            self.failed = None
+        except Exception:
+            logger.exception('Refresh of tag index failed')
+            self.failed = time.time()
+        finally:
+            self._refreshing.release()
+
+
+def popcount(bitmap):
+    return bin(bitmap).count('1')
+
+
+def bits(bitmap, start=0, stop=None):
+    """Generate positions of set bits in ascending order.
+
+    :param bitmap: integer used as bitmap
+    :param start: skip first start set bits
+    :param stop: stop after stop-th set bit
+    """
+    i = 0
+    while bitmap and (stop is None or i < stop):
+        low = bitmap & -bitmap
+        if i >= start:
+            yield low.bit_length() - 1
+        bitmap ^= low
+        i += 1
+
+
+_lock = threading.Lock()
+_shared = None
+
+
+def shared():
+    """Get process-wide index, or None when disabled in settings.
+
+    :return: TagIndex or None
+    """
+    global _shared
+    if not ENABLED:
+        return None
+    if _shared is None:
+        with _lock:
+            if _shared is None:
+                _shared = TagIndex()
+    return _shared
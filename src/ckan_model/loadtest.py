@@ -0,0 +1,215 @@
+import collections
+import http.cookies
+import io
+import math
+import random
+import threading
+import time
+import urllib.parse
+import wsgiref.util
+
+Sample = collections.namedtuple('Sample', 'route status duration')
+
+# scenario -> weight in generated traffic
+MIX = collections.OrderedDict([('browse', 6), ('profile', 3), ('edit', 1)])
+
+
+class Browser:
+    def __init__(self, application):
+        """One visitor of site. Requests are passed directly to WSGI
+        application, cookies (session, CSRF token) are kept between
+        requests as browser does.
+
+        :param application: WSGI application (sigma.wsgi.application)
+        """
+        self.application = application
+        self.cookies = {}
+        self.samples = []
+
+    def request(self, route, path, data=None):
+        """Make request and record its duration under route.
+
+        :param route: name of route in report, e.g. '/profile/<id>/'
+        :param path: path with query string
+        :param data: form data, request is POST when given
+        :return: (status code, body)
+        """
+        path, _, query = path.partition('?')
+        body = urllib.parse.urlencode(data or {}, doseq=True).encode()
+        environ = {'REQUEST_METHOD': 'GET' if data is None else 'POST',
+                   'PATH_INFO': urllib.parse.unquote(path),
+                   'QUERY_STRING': query,
+                   'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body)}
+        if self.cookies:
+            environ['HTTP_COOKIE'] = '; '.join(
+                '{}={}'.format(*cookie) for cookie in self.cookies.items())
+        if 'csrftoken' in self.cookies:
+            environ['HTTP_X_CSRFTOKEN'] = self.cookies['csrftoken']
+        wsgiref.util.setup_testing_defaults(environ)
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = headers
+
+        begin = time.perf_counter()
+        try:
+            result = self.application(environ, start_response)
+            try:
+                content = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            response['status'] = 0  # application crashed
+            content = b''
+        self.samples.append(Sample(route, response['status'],
+                                   time.perf_counter() - begin))
+
+        for name, value in response.get('headers', ()):
+            if name.lower() == 'set-cookie':
+                for morsel in http.cookies.SimpleCookie(value).values():
+                    self.cookies[morsel.key] = morsel.value
+        return response['status'], content
+
+    def login(self, username, password):
+        self.request('/auth/login/', '/auth/login/')
+        self.request('/auth/login/ POST', '/auth/login/',
+                     {'username': username, 'password': password})
+
+
+def browse(browser, data, rnd):
+    """Anonymous visitor: home page, search by tags, next page."""
+    browser.cookies.clear()
+    browser.request('/', '/')
+    tags = rnd.sample(data['tags'][:20], 2)
+    browser.request('/search/', '/search/?' + urllib.parse.urlencode(
+        {'selected_tags': tags}, doseq=True))
+    browser.request('/search/', '/search/?' + urllib.parse.urlencode(
+        {'selected_tags': tags[:1], 'page': 2}, doseq=True))
+
+
+def profile(browser, data, rnd, user):
+    """Logged in user views profiles of students and own profile."""
+    for name in rnd.sample(data['usernames'], 2):
+        browser.request('/profile/<id>/', '/profile/{}/'.format(name))
+    browser.request('/profile/<id>/', '/profile/{}/'.format(user))
+
+
+def edit(browser, data, rnd, user):
+    """Logged in student changes own profile."""
+    path = '/profile/{}/'.format(user)
+    browser.request('/profile/<id>/', path)
+    browser.request('/profile/<id>/ POST', path, {
+        'fullname': 'Student {}'.format(rnd.randrange(10 ** 6)),
+        'about': 'About',
+        'email': user + '@example.com'})
+
+
+def run(application, data, concurrency=8, duration=30, seed=0):
+    """Send mixed traffic from concurrent visitors to application.
+
+    :param application: WSGI application
+    :param data: dictionary with 'tags', 'usernames' (site users
+                 of students) and 'password' of them
+    :param concurrency: number of concurrent visitors
+    :param duration: seconds of generated traffic
+    :param seed: seed of random generator
+    :return: (list of Sample, elapsed seconds)
+    """
+    deadline = time.time() + duration
+    browsers = []
+    scenarios = list(MIX)
+    weights = list(MIX.values())
+
+    def visitor(n):
+        rnd = random.Random(seed + n)
+        browser = Browser(application)
+        browsers.append(browser)
+        user = data['usernames'][n % len(data['usernames'])]
+        logged_in = False
+        while time.time() < deadline:
+            scenario = rnd.choices(scenarios, weights)[0]
+            if scenario == 'browse':
+                browse(browser, data, rnd)
+                logged_in = False
+                continue
+            if not logged_in:
+                browser.login(user, data['password'])
+                logged_in = True
+            if scenario == 'profile':
+                profile(browser, data, rnd, user)
+            else:
+                edit(browser, data, rnd, user)
+
+    begin = time.perf_counter()
+    threads = [threading.Thread(target=visitor, args=(n,))
+               for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+    return [sample for browser in browsers
+            for sample in browser.samples], elapsed
+
+
+def percentile(values, p):
+    """Nearest-rank percentile.
+
+    :param values: sorted list
+    :param p: percentile 0-100
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def report(samples, elapsed):
+    """Throughput and latency of every route. Latency is measured on
+    successful requests, failed ones (crashes in particular) would
+    distort it.
+
+    :param samples: list of Sample
+    :param elapsed: seconds of test
+    :return: list of dictionaries {'route', 'requests', 'errors', 'rps',
+             'p50', 'p95', 'p99'} (latency in seconds, None when route
+             has no successful request), last is total
+    """
+    routes = collections.OrderedDict()
+    for sample in sorted(samples, key=lambda sample: sample.route):
+        routes.setdefault(sample.route, []).append(sample)
+    routes['total'] = samples
+    res = []
+    for route, route_samples in routes.items():
+        durations = sorted(sample.duration for sample in route_samples
+                           if 200 <= sample.status < 400)
+        res.append({'route': route,
+                    'requests': len(route_samples),
+                    'errors': len(route_samples) - len(durations),
+                    'rps': len(route_samples) / elapsed if elapsed else 0,
+                    'p50': percentile(durations, 50),
+                    'p95': percentile(durations, 95),
+                    'p99': percentile(durations, 99)})
+    return res
+
+
+def table(rows):
+    """Lines of table of report, missing latency is '-'.
+
+    :param rows: list returned by report
+    :return: list of strings
+    """
+    lines = ['{:<22} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8}'.format(
+        'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms')]
+    for row in rows:
+        latency = ['-' if row[p] is None else '{:.1f}'.format(row[p] * 1000)
+                   for p in ('p50', 'p95', 'p99')]
+        lines.append('{:<22} {:>8} {:>7} {:>8.1f} {:>8} {:>8} {:>8}'.format(
+            row['route'], row['requests'], row['errors'], row['rps'],
+            *latency))
+    return lines
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from ckan_model import production
+from ckan_model.models import PortfolioLink
+
+
+class Command(BaseCommand):
+    help = 'Remember portfolio of every student, which is in CKAN'
+
+    def handle(self, *args, **options):
+        start = 0
+        count = 0
+        while True:
+            res = production.package_search(
+                production.sysadmin, ['id', 'creator_user_id'],
+                q='groups:students', sort='name asc',
+                start=start, rows=1000)
+            for pkg in res['results']:
+                PortfolioLink.objects.update_or_create(
+                    user_id=pkg['creator_user_id'],
+                    defaults={'portfolio_id': pkg['id']})
+                count += 1
+            start += 1000
+            if start >= res['count'] or not res['results']:
+                break
+        self.stdout.write('{} portfolios linked'.format(count))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ckan_model import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Measure CKAN calls, bytes, time and memory of hot paths ' \
+           'against fake CKAN with generated students'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*',
+                            help='scenarios to run, default all: {}'.format(
+                                ', '.join(benchmark.SCENARIOS)))
+        parser.add_argument('--students', type=int, default=10000)
+        parser.add_argument('--items', type=int, default=3,
+                            help='portfolio items of every student')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='seconds added to every CKAN call')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='timed runs of every scenario, 0 only '
+                                 'counts CKAN calls')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--budgets', default=benchmark.BUDGETS,
+                            help='JSON file with CKAN calls of scenarios')
+        parser.add_argument('--record', action='store_true',
+                            help='save CKAN calls as new budgets')
+        parser.add_argument('--check', action='store_true',
+                            help='fail when scenario exceeds its budget')
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or list(benchmark.SCENARIOS)
+        for name in names:
+            if name not in benchmark.SCENARIOS:
+                raise CommandError('Unknown scenario ' + name)
+
+        self.stdout.write('Generating {} students'.format(
+            options['students']))
+        with benchmark.environment(options['students'], options['items'],
+                                   options['latency'],
+                                   options['seed']) as data:
+            results = [benchmark.run(name, data, options['repeat'])
+                       for name in names]
+
+        for line in benchmark.table(results):
+            self.stdout.write(line)
+
+        if options['record']:
+            benchmark.save_budgets(results, options['budgets'])
+        if options['check']:
+            exceeded = benchmark.over_budget(
+                results, benchmark.load_budgets(options['budgets']))
+            if exceeded:
+                raise CommandError('Over budget:\n' + '\n'.join(exceeded))
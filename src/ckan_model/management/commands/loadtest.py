@@ -0,0 +1,57 @@
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from ckan_model import benchmark, client, fake, loadtest
+from ckan_model.models import PortfolioLink
+
+
+class Command(BaseCommand):
+    help = 'Send mixed traffic to WSGI application of site backed by ' \
+           'fake CKAN and report throughput and latency of routes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=20,
+                            help='students which log in to site')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='concurrent visitors')
+        parser.add_argument('--duration', type=float, default=30,
+                            help='seconds of traffic')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='seconds added to every CKAN call')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write('Generating {} students'.format(
+            options['students']))
+        ckan = fake.FakeCKAN()
+        data = benchmark.generate(ckan, options['students'],
+                                  seed=options['seed'])
+        ckan.latency = options['latency']
+        previous = client.install(ckan)
+
+        password = uuid.uuid4().hex
+        users = [User.objects.create_user('loadtest_{}'.format(i),
+                                          password=password,
+                                          first_name=id)
+                 for i, id in enumerate(data['students'][:options['users']])]
+        data.update(usernames=[user.username for user in users],
+                    password=password)
+        try:
+            from sigma.wsgi import application
+            self.stdout.write('Running {} visitors for {} s'.format(
+                options['concurrency'], options['duration']))
+            samples, elapsed = loadtest.run(
+                application, data, options['concurrency'],
+                options['duration'], options['seed'])
+        finally:
+            PortfolioLink.objects.filter(
+                user_id__in=data['students']).delete()
+            for user in users:
+                user.delete()
+            client.install(previous)
+
+        for line in loadtest.table(loadtest.report(samples, elapsed)):
+            self.stdout.write(line)
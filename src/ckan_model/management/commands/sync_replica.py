@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ckan_model import policy, production, replica
+
+
+class Command(BaseCommand):
+    help = 'Mirror student portfolios, items and organizations from CKAN ' \
+           'into local replica, repeatedly until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=30,
+                            help='seconds between syncs')
+        parser.add_argument('--full-every', type=int, default=120,
+                            help='every n-th sync is full, so packages '
+                                 'deleted in CKAN are removed')
+        parser.add_argument('--once', action='store_true',
+                            help='sync once and exit')
+        parser.add_argument('--full', action='store_true',
+                            help='start with full sync')
+
+    def handle(self, *args, **options):
+        n = 0 if options['full'] else 1
+        while True:
+            full = options['full_every'] > 0 and \
+                n % options['full_every'] == 0
+            begin = time.time()
+            try:
+                res = replica.sync(production.sysadmin, full=full)
+            except Exception as e:
+                if not policy.is_failure(e):
+                    raise
+                # replica gets stale and reads fall back to CKAN
+                self.stderr.write('CKAN failed: {}'.format(e))
+            else:
+                self.stdout.write(
+                    '{} sync: {packages} packages, {removed} removed, '
+                    '{organizations} organizations in {time:.1f} s'.format(
+                        'full' if full else 'incremental',
+                        time=time.time() - begin, **res))
+            if options['once']:
+                break
+            n += 1
+            time.sleep(max(0, options['interval'] - (time.time() - begin)))
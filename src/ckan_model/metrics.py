@@ -0,0 +1,94 @@
+import collections
+import threading
+
+from . import parallel
+
+# upper bounds (seconds) of latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           float('inf'))
+
+Call = collections.namedtuple('Call', 'action duration size error')
+
+_lock = threading.Lock()
+_local = threading.local()
+_histograms = {}  # action -> [bucket counts, sum of durations, errors]
+
+
+def record(action, duration, size, error=None):
+    """Record one CKAN call into histograms and into calls of active
+    request.
+
+    :param action: name of CKAN action
+    :param duration: seconds
+    :param size: bytes of response, None when unknown
+    :param error: raised exception or None
+    """
+    with _lock:
+        histogram = _histograms.get(action)
+        if histogram is None:
+            histogram = _histograms[action] = [[0] * len(BUCKETS), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += duration
+        if error is not None:
+            histogram[2] += 1
+    calls = getattr(_local, 'calls', None)
+    if calls is not None:
+        calls.append(Call(action, duration, size,
+                          None if error is None else type(error).__name__))
+
+
+def start():
+    """Start collecting calls of request in this thread.
+    """
+    _local.calls = []
+
+
+def stop():
+    """Stop collecting calls of request.
+
+    :return: list of Call
+    """
+    calls = getattr(_local, 'calls', None)
+    _local.calls = None
+    return calls or []
+
+
+def _get_calls():
+    return getattr(_local, 'calls', None)
+
+
+def _set_calls(calls):
+    _local.calls = calls
+
+
+# calls made in parallel.gather belong to request which started them
+parallel.propagate(_get_calls, _set_calls)
+
+
+def export():
+    """Histograms in Prometheus text format.
+
+    :return: str
+    """
+    lines = ['# TYPE ckan_call_seconds histogram',
+             '# TYPE ckan_call_errors_total counter']
+    with _lock:
+        histograms = sorted((action, [list(h[0]), h[1], h[2]])
+                            for action, h in _histograms.items())
+    for action, (buckets, total, errors) in histograms:
+        count = 0
+        for bound, n in zip(BUCKETS, buckets):
+            count += n
+            lines.append('ckan_call_seconds_bucket{{action="{}",le="{}"}} {}'
+                         .format(action, '+Inf' if bound == float('inf')
+                                 else bound, count))
+        lines.append('ckan_call_seconds_sum{{action="{}"}} {}'
+                     .format(action, total))
+        lines.append('ckan_call_seconds_count{{action="{}"}} {}'
+                     .format(action, count))
+        lines.append('ckan_call_errors_total{{action="{}"}} {}'
+                     .format(action, errors))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,70 @@
+import collections
+import json
+import logging
+import time
+
+from . import identity, metrics, policy
+
+logger = logging.getLogger(__name__)
+
+
+class CKANMetricsMiddleware:
+    """Collect CKAN calls made while handling request. Their count
+    and duration are sent in Server-Timing header and logged as one
+    JSON line per request.
+    """
+    def process_request(self, request):
+        request.ckan_begin = time.time()
+        metrics.start()
+
+    def process_response(self, request, response):
+        calls = metrics.stop()
+        actions = collections.OrderedDict()
+        for call in calls:
+            count, duration = actions.get(call.action, (0, 0.0))
+            actions[call.action] = (count + 1, duration + call.duration)
+
+        timing = ['ckan;dur={:.1f};desc="{} calls"'.format(
+            sum(call.duration for call in calls) * 1000, len(calls))]
+        timing += ['ckan-{};dur={:.1f};desc="{} calls"'.format(
+            action, duration * 1000, count)
+            for action, (count, duration) in actions.items()]
+        response['Server-Timing'] = ', '.join(timing)
+
+        logger.info(json.dumps({
+            'path': request.path,
+            'status': response.status_code,
+            'duration': time.time() - getattr(request, 'ckan_begin',
+                                              time.time()),
+            'ckan_calls': len(calls),
+            'ckan_duration': sum(call.duration for call in calls),
+            'ckan_bytes': sum(call.size or 0 for call in calls),
+            'ckan_errors': [call.action for call in calls if call.error],
+            'ckan_actions': {action: count
+                             for action, (count, _) in actions.items()},
+        }))
+        return response
+
+
+class IdentityMapMiddleware:
+    """Every CKAN entity is loaded at most once while handling request,
+    all User, Organization and StudentPortfolio objects share it.
+    """
+    def process_request(self, request):
+        identity.start()
+
+    def process_response(self, request, response):
+        identity.stop()
+        return response
+
+
+class CKANDeadlineMiddleware:
+    """CKAN calls made while handling request share deadline, so
+    slow CKAN can't hold worker longer than CKAN_REQUEST_BUDGET.
+    """
+    def process_request(self, request):
+        policy.start()
+
+    def process_response(self, request, response):
+        policy.stop()
+        return response
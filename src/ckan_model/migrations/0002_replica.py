@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ckan_model', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplicaOrganization',
+            fields=[
+                ('id', models.CharField(serialize=False, max_length=100, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=100)),
+                ('category', models.CharField(null=True, max_length=50, db_index=True)),
+                ('data', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReplicaPackage',
+            fields=[
+                ('id', models.CharField(serialize=False, max_length=100, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=100)),
+                ('kind', models.CharField(max_length=10, db_index=True)),
+                ('creator_user_id', models.CharField(max_length=100, db_index=True)),
+                ('organization', models.CharField(null=True, max_length=100, db_index=True)),
+                ('metadata_modified', models.CharField(max_length=50, db_index=True)),
+                ('data', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReplicaState',
+            fields=[
+                ('key', models.CharField(serialize=False, max_length=50, primary_key=True)),
+                ('value', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReplicaTag',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=100, db_index=True)),
+                ('package', models.ForeignKey(related_name='tags', to='ckan_model.ReplicaPackage', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='replicatag',
+            unique_together=set([('package', 'name')]),
+        ),
+    ]
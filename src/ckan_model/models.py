@@ -0,0 +1,50 @@
+from django.db import models
+
+
+class PortfolioLink(models.Model):
+    """Student portfolio package of CKAN user. Portfolio is then
+    loaded by id instead of searching for it.
+    """
+    user_id = models.CharField(max_length=100, unique=True)
+    portfolio_id = models.CharField(max_length=100, unique=True)
+
+
+class ReplicaOrganization(models.Model):
+    """Organization mirrored from CKAN by sync_replica.
+    """
+    id = models.CharField(max_length=100, primary_key=True)
+    name = models.CharField(max_length=100, unique=True)
+    category = models.CharField(max_length=50, null=True, db_index=True)
+    data = models.TextField()  # JSON of organization as returned by CKAN
+
+
+class ReplicaPackage(models.Model):
+    """Student portfolio or portfolio item mirrored from CKAN.
+    """
+    PORTFOLIO = 'portfolio'
+    ITEM = 'item'
+
+    id = models.CharField(max_length=100, primary_key=True)
+    name = models.CharField(max_length=100, unique=True)
+    kind = models.CharField(max_length=10, db_index=True)
+    creator_user_id = models.CharField(max_length=100, db_index=True)
+    organization = models.CharField(max_length=100, null=True,
+                                    db_index=True)
+    metadata_modified = models.CharField(max_length=50, db_index=True)
+    data = models.TextField()  # JSON of package as returned by CKAN
+
+
+class ReplicaTag(models.Model):
+    package = models.ForeignKey(ReplicaPackage, related_name='tags',
+                                on_delete=models.CASCADE)
+    name = models.CharField(max_length=100, db_index=True)
+
+    class Meta:
+        unique_together = ('package', 'name')
+
+
+class ReplicaState(models.Model):
+    """Progress of sync_replica (last modification seen, time of sync).
+    """
+    key = models.CharField(max_length=50, primary_key=True)
+    value = models.CharField(max_length=100)
@@ -0,0 +1,130 @@
+import concurrent.futures
+import functools
+import itertools
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+# threads for concurrent CKAN calls
+WORKERS = getattr(settings, 'CKAN_WORKERS', 8)
+# default seconds to wait for gathered calls
+TIMEOUT = getattr(settings, 'CKAN_GATHER_TIMEOUT', 30)
+
+_lock = threading.Lock()
+_executor = None
+_local = threading.local()
+_context = []  # (get, set) of thread local state passed to workers
+
+
+def executor():
+    """Get process-wide thread pool for CKAN calls.
+
+    :return: concurrent.futures.ThreadPoolExecutor
+    """
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(WORKERS)
+    return _executor
+
+
+def propagate(get, set):
+    """Register thread local state, which gathered calls share with
+    thread which called gather (e.g. state of current request).
+
+    :param get: function returning state of current thread
+    :param set: function setting state of current thread
+    """
+    _context.append((get, set))
+
+
+def _run(call, context):
+    _local.worker = True
+    for (get, set), value in zip(_context, context):
+        set(value)
+    try:
+        return call()
+    finally:
+        for get, set in _context:
+            set(None)
+        _local.worker = False
+        connections.close_all()  # database connections of this thread
+
+
+def gather(*calls, timeout=TIMEOUT):
+    """Call independent functions concurrently. Page which needs
+    several CKAN calls then waits for the slowest one instead of sum
+    of all. Calls made from inside of gathered function run one after
+    another, so pool can't deadlock on itself.
+
+    example:
+    tags, unis = gather(search.tags_list, search.university_list)
+
+    :param calls: functions without arguments (use lambda or partial)
+    :param timeout: seconds to wait for all results, None for no limit
+    :return: list of results in order of calls
+    :raise concurrent.futures.TimeoutError: when timeout expires
+    :raise Exception: first exception raised by calls
+    """
+    if getattr(_local, 'worker', False) or len(calls) < 2:
+        return [call() for call in calls]
+
+    deadline = None if timeout is None else time.time() + timeout
+    context = [get() for get, set in _context]
+    futures = [executor().submit(_run, call, context) for call in calls]
+    try:
+        return [future.result(None if deadline is None
+                              else max(0, deadline - time.time()))
+                for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def each(function, items, limit=WORKERS, timeout=TIMEOUT):
+    """Call function for every item concurrently, at most limit calls
+    run at once. Failure of one call doesn't stop others.
+
+    :param function: function with one argument
+    :param items: arguments
+    :param limit: maximal number of concurrent calls
+    :param timeout: seconds to wait for all results, None for no limit
+    :return: list of results or raised exceptions in order of items
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    def call(i):
+        try:
+            results[i] = function(items[i])
+        except Exception as e:
+            results[i] = e
+
+    if getattr(_local, 'worker', False) or limit < 2:
+        for i in range(len(items)):
+            call(i)
+        return results
+
+    deadline = None if timeout is None else time.time() + timeout
+    context = [get() for get, set in _context]
+    pending = set()
+    waiting = iter(range(len(items)))
+    try:
+        while True:
+            for i in itertools.islice(waiting, limit - len(pending)):
+                pending.add(executor().submit(
+                    _run, functools.partial(call, i), context))
+            if not pending:
+                return results
+            done, pending = concurrent.futures.wait(
+                pending,
+                None if deadline is None else max(0, deadline - time.time()),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                raise concurrent.futures.TimeoutError
+    finally:
+        for future in pending:
+            future.cancel()
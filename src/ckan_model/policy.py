@@ -0,0 +1,212 @@
+import random
+import threading
+import time
+
+import ckanapi
+import requests
+from django.conf import settings
+
+from . import parallel
+
+# seconds to wait for response of action, 'default' for other actions
+TIMEOUTS = getattr(settings, 'CKAN_TIMEOUTS', {'package_search': 10,
+                                               'default': 5})
+# seconds which all CKAN calls of one request may take together
+BUDGET = getattr(settings, 'CKAN_REQUEST_BUDGET', 20)
+# repeated attempts of failed reads, first one waits up to BACKOFF seconds
+RETRIES = getattr(settings, 'CKAN_RETRIES', 2)
+BACKOFF = getattr(settings, 'CKAN_BACKOFF', 0.1)
+# failures in row after which CKAN isn't called for BREAKER_RESET seconds
+BREAKER_FAILURES = getattr(settings, 'CKAN_BREAKER_FAILURES', 5)
+BREAKER_RESET = getattr(settings, 'CKAN_BREAKER_RESET', 30)
+
+# actions without side effects, which can be safely repeated and
+# coalesced; name of action doesn't tell it (e.g. *_list_for_user)
+READ_ACTIONS = {'organization_list', 'organization_list_for_user',
+                'organization_show', 'package_search', 'package_show',
+                'status_show', 'tag_list', 'user_show'}
+
+_local = threading.local()
+
+
+def start(budget=BUDGET):
+    """Start deadline of current request, CKAN calls made after
+    budget is spent fail without waiting for CKAN.
+
+    :param budget: seconds, None for no deadline
+    """
+    _local.deadline = None if budget is None else time.time() + budget
+
+
+def stop():
+    """Drop deadline of current request.
+    """
+    _local.deadline = None
+
+
+def _get():
+    return getattr(_local, 'deadline', None)
+
+
+def _set(deadline):
+    _local.deadline = deadline
+
+
+# calls made in parallel.gather share deadline of request
+parallel.propagate(_get, _set)
+
+
+def remaining():
+    """Seconds left until deadline of current request.
+
+    :return: float, None when there is no deadline
+    """
+    deadline = _get()
+    return None if deadline is None else deadline - time.time()
+
+
+def is_idempotent(action):
+    """
+    :param action: name of CKAN action
+    :return: True when action is known to only read data
+    """
+    return action in READ_ACTIONS
+
+
+def is_failure(error):
+    """Tell failure of CKAN itself (unreachable, timeout, server error)
+    from error of call (NotFound, ValidationError, ...).
+
+    :param error: exception raised by call
+    :return: bool
+    """
+    return (isinstance(error, (Unavailable, requests.RequestException,
+                               ckanapi.ServerIncompatibleError)) or
+            type(error) is ckanapi.CKANAPIError)
+
+
+class Breaker:
+    def __init__(self, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        """Circuit breaker. After failures in row it is open and calls
+        fail immediately. When reset seconds pass, one call is let
+        through and its result closes breaker or opens it again.
+
+        :param failures: failures in row which open breaker
+        :param reset: seconds for which breaker stays open
+        """
+        self.failures = failures
+        self.reset = reset
+        self._lock = threading.Lock()
+        self._count = 0
+        self._opened = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def allow(self):
+        """
+        :return: True when call may be made
+        """
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or time.time() - self._opened < self.reset:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._count = 0
+            self._opened = None
+            self._trial = False
+
+    def release(self):
+        """End call which failed for other reason than CKAN (e.g. its
+        time was cut by deadline of request), without counting it.
+        """
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            self._trial = False
+            if self._opened is not None or self._count >= self.failures:
+                self._opened = time.time()
+
+
+breaker = Breaker()
+
+
+def call(action, attempt):
+    """Call CKAN action within timeout of action and deadline of
+    request. Failed reads are repeated after random (jittered) wait,
+    writes are made only once. When CKAN fails repeatedly, breaker
+    opens and calls fail immediately, so workers don't pile up waiting
+    for it. Breaker counts one failure per call, whatever number of
+    attempts; timeouts shortened by deadline of request aren't counted,
+    they are caused by slow request rather than CKAN.
+
+    :param action: name of CKAN action
+    :param attempt: function(timeout) making one call
+    :return: result of attempt
+    :raise Unavailable: breaker is open
+    :raise DeadlineExceeded: deadline of request passed
+    """
+    attempts = 1 + (RETRIES if is_idempotent(action) else 0)
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(action)
+    if not breaker.allow():
+        raise Unavailable(action)
+    failed = False  # CKAN itself failed in some attempt
+    for i in range(attempts):
+        timeout = TIMEOUTS.get(action, TIMEOUTS.get('default'))
+        clamped = False
+        left = remaining()
+        if left is not None:
+            if left <= 0:
+                _end(failed)
+                raise DeadlineExceeded(action)
+            if timeout is None or left < timeout:
+                timeout, clamped = left, True
+        try:
+            result = attempt(timeout)
+        except Exception as e:
+            if not is_failure(e):
+                breaker.success()  # CKAN answered
+                raise
+            failed = failed or not (
+                clamped and isinstance(e, requests.Timeout))
+            delay = random.uniform(0, BACKOFF * 2 ** i)
+            left = remaining()
+            if i + 1 == attempts or (left is not None and left <= delay):
+                _end(failed)
+                raise
+            time.sleep(delay)
+        else:
+            breaker.success()
+            return result
+
+
+def _end(failed):
+    if failed:
+        breaker.failure()
+    else:
+        breaker.release()
+
+
+class Unavailable(Exception):
+    def __init__(self, action):
+        super().__init__("CKAN is unavailable, {} not called".format(action))
+        self.action = action
+
+
+class DeadlineExceeded(Unavailable):
+    def __init__(self, action):
+        Exception.__init__(
+            self, "Time for CKAN calls ran out, {} not called".format(action))
+        self.action = action
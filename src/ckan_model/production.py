@@ -1,24 +1,54 @@
+import collections
+import contextlib
+import json
 import random
 import ckanapi
 import string
+import threading
 import operator
 import re
 import uuid
 
-sysadmin = ckanapi.RemoteCKAN("http://ckan.local",
-                              "cd609119-9305-48bb-8b9c-5b3083252d80")
+from django.conf import settings
+
+from . import identity, index, parallel, replica
+from .cache import cached, invalidate
+from .client import Client, connect, SYSADMIN_APIKEY
+from .cursor import decode as decode_cursor, page as page_cursors
+from .models import PortfolioLink
+
+sysadmin = connect(SYSADMIN_APIKEY)
+# organizations loaded with all fields at once, must not exceed
+# ckan.group_and_organization_list_all_fields_max of CKAN (default 25)
+ORGANIZATION_PAGE = getattr(settings, 'CKAN_ORGANIZATION_PAGE', 25)
 
 
 class Search:
-    def __init__(self, ckan: ckanapi.RemoteCKAN = None):
+    fields = ['id', 'name', 'title', 'tags']  # fields used from packages
+
+    def __init__(self, ckan: Client = None, tag_index=None, use_index=True):
+        """
+        :param ckan: CKAN API
+        :param tag_index: index.TagIndex used for students search,
+                          default is shared index when enabled in settings
+        :param use_index: False to search only in CKAN (or replica)
+        """
         if ckan is None:
-            self.ckan = ckanapi.RemoteCKAN("http://ckan.local")
+            self.ckan = connect()
         else:
             self.ckan = ckan
-
-    def students(self, tags=None, universities=None, start=0, rows=10):
+        if not use_index:
+            tag_index = None
+        elif tag_index is None:
+            tag_index = index.shared()
+        self.tag_index = tag_index
+
+    def students(self, tags=None, universities=None, start=0, rows=10,
+                 ranked=False, weighted=False, cursor=None):
         """Search for students by their tags. Use parameters
-        start and rows for handle pagination.
+        start and rows for handle pagination, or cursor returned in
+        previous result for next or previous page. Cursor pagination
+        doesn't get slower on deep pages.
         Format of dict in returned list:
         {'name': Student's name,
          'tags_matched': [list of matched tags]
@@ -26,13 +56,24 @@ class Search:
                            but was not specified in query]
         }
 
+        Ranked search orders students by number of matched tags,
+        weighted search prefers students with rare tags. Ranking is
+        done by Solr (or by top-k selection in tag index), so only
+        requested page is transferred.
+
         :param universities: List of universities (names)
         :param tags: List of tags
         :param start: position of first item
         :param rows: limit of returned results [max value: 1000]
-        :return: Dictionary with keys total and results.
+        :param ranked: order by relevance instead of default order
+        :param weighted: weight matched tags by their rarity
+        :param cursor: cursor 'next' or 'prev' from previous result,
+                       parameter start is ignored
+        :return: Dictionary with keys total, results, start, next, prev.
                 'results' contains:
                 List of dictionaries with information about students
+                'next' and 'prev' are cursors or None (also in
+                ranked search, which can't use cursors)
         """
         if rows > 1000:
             raise ValueError('Parameter rows over limit 1000')
@@ -40,27 +81,118 @@ class Search:
             universities = []
         if not tags:
             tags = []
+        ranked = ranked and bool(tags)
+        # index is used once it is loaded, until then Solr answers
+        tag_index = self.tag_index
+        if tag_index is not None and not tag_index.ready():
+            tag_index = None
+        if cursor is not None:
+            if ranked:
+                raise ValueError('Cursor can not be used in ranked search')
+            if tag_index is not None:
+                cursor = decode_cursor(cursor, int, tag_index.size)
+            else:
+                cursor = decode_cursor(cursor)
+            start = cursor['position']
+
+        if tag_index is not None:
+            return tag_index.students(tags, universities, start, rows,
+                                           ranked=ranked, weighted=weighted,
+                                           cursor=cursor)
+
+        if replica.available() and not weighted:
+            # idf weighting is left to Solr
+            res = replica.search(tags, universities,
+                                 start if cursor is None else 0, rows,
+                                 ranked=ranked, cursor=cursor)
+            total = res['count']
+            if cursor is not None and 'after' in cursor:
+                total += start
+            elif cursor is not None:
+                total = cursor['total']
+                res['results'].reverse()
+        elif ranked:
+            res = package_search(
+                self.ckan, self.fields,
+                q=self._prepare_ranked_query(tags, weighted),
+                fq=self._prepare_query([], 'students', universities),
+                sort='score desc, name asc',
+                start=start, rows=rows)
+            total = res['count']
+        else:
+            query = self._prepare_query(tags, 'students', universities)
+            params = self._prepare_keyset(cursor)
+            res = package_search(
+                self.ckan, self.fields,
+                q=query, start=start if cursor is None else 0, rows=rows,
+                **params)
+            if cursor is None:
+                total = res['count']
+            elif 'after' in cursor:
+                total = start + res['count']
+            else:
+                total = cursor['total']
+                res['results'].reverse()
+        results = [{
+            'title': student['title'],
+            'name': student['name'],
+            'tags_matched': [tag['name'] for tag in student['tags']
+                             if tag['name'] in tags],
+            'tags_unmatched': [tag['name'] for tag in student['tags']
+                               if tag['name'] not in tags],
+        } for student in res['results']]
+        prev = next = None
+        if not ranked and results:
+            prev, next = page_cursors(results[0]['name'],
+                                      results[-1]['name'],
+                                      start, len(results), rows, total)
+        return {'total': total,
+                'start': start,
+                'results': results,
+                'prev': prev,
+                'next': next}
 
-        query = self._prepare_query(tags, 'students', universities)
-        res = self.ckan.action.package_search(q=query, start=start, rows=rows)
-        for student in res['results']:
-            student['tags_matched'] = [tag['name'] for tag in student['tags']
-                                       if tag['name'] in tags]
-            student['tags_unmatched'] = [tag['name'] for tag in student['tags']
-                                         if tag['name'] not in tags]
-        return {'total': res['count'],
-                'results': select(res['results'],
-                                  ["title",
-                                   "name",
-                                   'tags_matched',
-                                   'tags_unmatched'])}
+    def iter_students(self, tags=None, universities=None, rows=1000):
+        """Generate all students found by search. Pages are loaded
+        from CKAN only when previous page was consumed, so memory
+        doesn't depend on number of results.
 
+        :param tags: List of tags
+        :param universities: List of universities (names)
+        :param rows: size of loaded pages [max value: 1000]
+        :return: generator of dictionaries as in students
+        """
+        cursor = None
+        while True:
+            res = self.students(tags, universities, rows=rows, cursor=cursor)
+            yield from res['results']
+            cursor = res['next']
+            if cursor is None:
+                break
+
+    @staticmethod
+    def _prepare_keyset(cursor):
+        """Filter and sort for page given by cursor. Students are
+        ordered by unique name, so page continues after (or ends
+        before) name stored in cursor.
+        """
+        if cursor is None:
+            return {'sort': 'name asc'}
+        if 'after' in cursor:
+            return {'fq': 'name:{{{} TO *]'.format(quote(cursor['after'])),
+                    'sort': 'name asc'}
+        return {'fq': 'name:[* TO {}}}'.format(quote(cursor['before'])),
+                'sort': 'name desc'}
+
+    @cached('top_tags')
     def top_tags(self, limit=10):
         """Get most used tags in descending order
 
         :param limit: Limit of returned tags, default 10
         :return: List of dictionaries: {'count', 'name'}
         """
+        if replica.available():
+            return replica.top_tags(limit)
         res = self.ckan.call_action('package_search',
                                     {'facet.field': ['tags'],
                                      'facet.limit': limit})
@@ -71,41 +203,48 @@ class Search:
         res = select(res, ["count", "name"])
         return res
 
+    @cached('tags_list')
     def tags_list(self):
         """Get all tags
 
         :return: List of tags
         """
+        if replica.available():
+            return replica.tags_list()
         return self.ckan.call_action('tag_list')
 
     @staticmethod
     def _prepare_query(tags, group, organizations):
         q = "groups:{}".format(group)
         if len(tags) > 0:
-            tags = " OR ".join(tags)
-            q += " AND tags:(\"{}\")".format(tags)
+            tags = " OR ".join(quote(tag) for tag in tags)
+            q += " AND tags:({})".format(tags)
         if len(organizations) > 0:
             q += " AND organization:({})".format(" OR ".join(organizations))
 
         return q
 
+    @staticmethod
+    def _prepare_ranked_query(tags, weighted):
+        """Query which score is number of matched tags. Weighted query
+        keeps Solr's scoring, whose idf prefers rare tags.
+        """
+        boost = "" if weighted else "^=1"
+        return " OR ".join("tags:{}{}".format(quote(tag), boost)
+                           for tag in tags)
+
+    @cached('university_list')
     def university_list(self):
         """Get list of universities
 
         :return: List of universities [{'name': ID, 'title': NAME}, ...]
         """
+        if replica.available():
+            return select(replica.universities(),
+                          {'name': 'name', 'display_name': 'title'})
 
-        def filter_uni(org):
-            if not org['extras']:
-                return False
-            category = [extra['value'] for extra in org['extras']
-                        if extra['key'] == 'Category']
-            return category and category[0] == "University"
-
-        res = self.ckan.call_action('organization_list',
-                                    {'all_fields': True,
-                                     'include_extras': True})
-        res = filter(filter_uni, res)
+        res = organization_list(self.ckan)
+        res = filter(lambda org: category(org) == "University", res)
         return select(res, {'name': 'name', 'display_name': 'title'})
 
 
@@ -113,12 +252,17 @@ class User:
     def __init__(self, id):
 
         try:
-            self.user = sysadmin.call_action('user_show', {'id': id})
+            self.user = identity.load(
+                'user', id,
+                lambda: sysadmin.call_action('user_show', {'id': id}))
         except ckanapi.NotFound as e:
             raise UserNotFound from e
+        # user as it was in CKAN, to find changed attributes
+        self._saved = self.user
+        self._changed = None
+        self._memberships = {}
 
-        self.ckan = ckanapi.RemoteCKAN("http://ckan.local",
-                                       self.user["apikey"])
+        self.ckan = connect(self.user["apikey"])
         self.search = Search(self.ckan)
 
     @staticmethod
@@ -183,10 +327,60 @@ class User:
     def email(self, value):
         self._update('email', value)
 
+    @contextlib.contextmanager
+    def edit(self):
+        """Collect changes of attributes and save them at once
+        when block ends without exception. When block or saving
+        fails, attributes are restored.
+
+        example:
+        with user.edit():
+            user.fullname = 'Name'
+            user.email = 'name@example.com'
+        """
+        self._changed = set()
+        user = self.user
+        try:
+            yield self
+            if self._changed:
+                self.save()
+        except BaseException:
+            self.user = user
+            raise
+        finally:
+            self._changed = None
+
     def _update(self, key, value):
-        self.user = self.ckan.call_action('user_show', {'id': self.id})
+        user = self.user
+        self.user = dict(self.user)
         self.user[key] = value
-        self.user = self.ckan.call_action('user_update', self.user)
+        if self._changed is None:
+            try:
+                self.save()
+            except BaseException:
+                self.user = user
+                raise
+        else:
+            self._changed.add(key)
+
+    def save(self):
+        """Save changed attributes to CKAN. User is read from CKAN
+        again, so attributes changed meanwhile by others are kept.
+
+        :raise UserConflictError: when changed attribute was changed
+               in CKAN to another value since user was loaded
+        """
+        changed = {key: value for key, value in self.user.items()
+                   if value != self._saved.get(key)}
+        user = self.ckan.call_action('user_show', {'id': self.id})
+        for key, value in changed.items():
+            if user.get(key) not in (self._saved.get(key), value):
+                raise UserConflictError(key)
+        user.update(changed)
+        self.user = self._saved = self.ckan.call_action('user_update', user)
+        identity.store('user', self.user)
+        if self._changed is not None:
+            self._changed.clear()
 
     def delete(self):
         """Mark user as deleted.
@@ -197,15 +391,28 @@ class User:
         self.ckan.call_action("user_delete", {"id": self.id})
 
     def student_portfolio(self):
-        """get students portfolio
+        """get students portfolio. Portfolio remembered in database
+        is loaded by id, others are searched in CKAN.
 
         :raise NotFound
         :raise CKANConsistentError
         :return: StudentPortfolio class
         """
-        return StudentPortfolio(self.ckan, username=self.user['name'])
+        link = PortfolioLink.objects.filter(user_id=self.id).first()
+        if link is not None:
+            try:
+                return StudentPortfolio(self.ckan, id=link.portfolio_id)
+            except ckanapi.NotFound:
+                link.delete()
+        portfolio = StudentPortfolio(self.ckan, username=self.user['name'],
+                                     user_id=self.id)
+        PortfolioLink.objects.get_or_create(
+            user_id=self.id, defaults={'portfolio_id': portfolio.cv['id']})
+        return portfolio
 
     def is_student(self):
+        if PortfolioLink.objects.filter(user_id=self.id).exists():
+            return True
         try:
             self.student_portfolio()
         except NotFound:
@@ -228,17 +435,21 @@ class User:
 
         self.add_to_group('students')
         self.add_to_group('students-work')
-        return StudentPortfolio.create_student_portfolio(
+        portfolio = StudentPortfolio.create_student_portfolio(
             self.ckan,
             self.user['name'],
             self.user['display_name'],
             university.id)
+        PortfolioLink.objects.update_or_create(
+            user_id=self.id, defaults={'portfolio_id': portfolio.cv['id']})
+        return portfolio
 
     def add_to_organization(self, organization):
         sysadmin.call_action('organization_member_create',
                              {'id': organization,
                               'username': self.id,
                               'role': 'editor'})
+        self._memberships.clear()
 
     def add_to_group(self, group):
         sysadmin.call_action('group_member_create',
@@ -250,46 +461,80 @@ class User:
         """List of organizations, of which user is a member
         :return: list which contains short names for university
         """
-        res = self.ckan.call_action('organization_list_for_user',
-                                    {'permission': 'read'})
-        return [Organization(self.ckan, org['id']) for org in res]
+        return [Organization(self.ckan, data=org)
+                for org in self.memberships('read')]
 
     def admin_of(self):
         """List of organizations, of which user is a admin
         :return: list which contains Organization
         """
-        res = self.ckan.call_action('organization_list_for_user',
-                                    {'permission': 'admin'})
-        return [Organization(self.ckan, org['id']) for org in res]
+        return [Organization(self.ckan, data=org)
+                for org in self.memberships('admin')]
+
+    def memberships(self, permission='read'):
+        """Organizations of user with all fields and extras. They are
+        loaded by two CKAN calls (more for user in over ORGANIZATION_PAGE
+        organizations) and remembered by this object.
+
+        :param permission: 'read' for member, 'admin' for admin
+        :return: list of organization dictionaries
+        """
+        if permission not in self._memberships:
+            res = self.ckan.call_action('organization_list_for_user',
+                                        {'permission': permission})
+            self._memberships[permission] = [
+                org.org for org in Organization.bulk_load(
+                    self.ckan, [org['name'] for org in res])]
+        return self._memberships[permission]
 
     def universities(self):
-        """List of universities for user
-        :return: list if short names (url) for universities
+        """Universities of user
+        :return: iterator of Organization
         """
-        return filter(lambda org:
-                      org.name in
-                      [uni['name'] for uni in self.search.university_list()],
-                      self.member_of())
+        return (Organization(self.ckan, data=org)
+                for org in self.memberships()
+                if category(org) == "University")
 
     def companies(self):
-        raise NotImplementedError  # TODO
+        """Companies of user
+        :return: iterator of Organization
+        """
+        return (Organization(self.ckan, data=org)
+                for org in self.memberships()
+                if category(org) == "Company")
 
 
 class StudentPortfolio:
-    def __init__(self, ckan: ckanapi.RemoteCKAN, *, username=None, id=None):
+    def __init__(self, ckan: Client, *, username=None, id=None,
+                 user_id=None):
         """Construct student portfolio from user name
 
         :param ckan: CKAN API from active user
         :param name: user name or id
+        :param user_id: id of user with username, portfolio is then
+                        found by its exact creator instead of author
         :raise CKANConsistentError: When student has more profile
         """
         self.inc = 1000  # results return at once from CKAN, maximum 1000
         self.ckan = ckan
         if id is not None:
-            self.cv = self.ckan.action.package_show(id=id)
+            self.cv = identity.load(
+                'package', id, lambda: _package_show(self.ckan, id))
         elif username is not None:
-            query = 'author:"{}" AND groups:students'.format(username)
-            res = ckan.call_action('package_search', {'q': query})
+            portfolio = None
+            if user_id is not None and replica.available():
+                portfolio = replica.portfolio_of(user_id)
+            if portfolio is not None:
+                res = {'count': 1, 'results': [portfolio]}
+            elif user_id is not None:
+                # creator is indexed as string, so only owner's
+                # portfolio is returned
+                res = ckan.call_action('package_search', {
+                    'q': 'groups:students',
+                    'fq': 'creator_user_id:"{}"'.format(user_id)})
+            else:
+                query = 'author:"{}" AND groups:students'.format(username)
+                res = ckan.call_action('package_search', {'q': query})
             count = res['count']
             res = res['results']
             if count == 0:
@@ -316,7 +561,7 @@ class StudentPortfolio:
 
     @property
     def university(self):
-        return Organization(self.cv['owner_org']['id'])
+        return Organization(self.ckan, data=self.cv['organization'])
 
     @classmethod
     def create_student_portfolio(cls, ckan, username, fullname, university):
@@ -326,6 +571,7 @@ class StudentPortfolio:
                 'groups': [{'name': 'students'}],
                 'owner_org': university,
                 'author': username,
+                'extras': [{'key': 'tag_counts', 'value': '{}'}],
                 }
 
         res = url_retry(ckan, url, data)
@@ -344,25 +590,48 @@ class StudentPortfolio:
 
         :return: List: [{'id': str, 'title': str, 'tags': [str, ...]}, ...]
         """
-
-        items = []
-        start = 0
-
+        return list(self.iter_items())
+
+    def iter_items(self, limit=None, sort=None, fresh=False):
+        """Generate items from portfolio. Pages are loaded from CKAN
+        only when previous page was consumed, so stopping early saves
+        both CKAN calls and memory.
+
+        :param limit: maximal number of items, None for all
+        :param sort: CKAN sort, e.g. 'metadata_modified desc'
+        :param fresh: load from CKAN even when replica is available,
+                      for items which are written back
+        :return: generator of PortfolioItem
+        """
+        rows = self.inc if limit is None else min(self.inc, limit)
+        # items are created by owner of portfolio
+        params = {'q': 'groups:students-work',
+                  'fq': 'creator_user_id:"{}"'.format(
+                      self.cv['creator_user_id']),
+                  'start': 0,
+                  'rows': rows}
+        if sort is not None:
+            params['sort'] = sort
+        if not fresh and replica.available():
+            for item in replica.items(self.cv['creator_user_id'], limit,
+                                      sort):
+                if item['author'] != self.username:
+                    raise CKANConsistentError(item['id'])
+                yield PortfolioItem(self, data=item)
+            return
+        count = 0
         while True:
-            res = self.ckan.call_action('package_search', {
-                'q': 'author:{} AND groups:students-work'.format(self.username),
-                'start': start,
-                'rows': self.inc})
-            items += [PortfolioItem(self, data=item)
-                      for item in res['results']]
-            if len(items) < res['count']:
-                start += self.inc
-                continue
-            else:
-                break
-        items = list(filter(lambda it: it.author==self.username, items))
-
-        return items
+            res = package_search(self.ckan, PortfolioItem.fields, **params)
+            for item in res['results']:
+                if item['author'] != self.username:
+                    raise CKANConsistentError(item['id'])
+                yield PortfolioItem(self, data=item)
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            params['start'] += rows
+            if params['start'] >= res['count'] or not res['results']:
+                return
 
     def add_item(self, title, description, tags):
         """ Add one item to students portfolio.
@@ -372,6 +641,36 @@ class StudentPortfolio:
         :param tags:
         :return: :raise UrlConflictError:
         """
+        pkg = self._create_item(title, description, tags)
+        self.update_tags(added=set(tags))
+        invalidate('tags_list', 'top_tags')
+        return PortfolioItem(self, data=pkg)
+
+    def add_items(self, items, workers=4):
+        """Add more items to students portfolio at once. Items are
+        created concurrently and tags of portfolio are updated once.
+
+        :param items: List of dictionaries with keys title,
+                      description and tags
+        :param workers: maximal number of items created at once
+        :return: List with PortfolioItem for created item or exception
+                 for failed item, in order of items
+        """
+        # no timeout: items created after it would be missing in counts,
+        # every CKAN call is still limited by deadline of request
+        res = parallel.each(lambda item: self._create_item(
+            item['title'], item['description'], item['tags']),
+            items, limit=workers, timeout=None)
+        added = collections.Counter()
+        for item, pkg in zip(items, res):
+            if not isinstance(pkg, Exception):
+                added.update(set(item['tags']))
+        self.update_tags(added=added)
+        invalidate('tags_list', 'top_tags')
+        return [pkg if isinstance(pkg, Exception)
+                else PortfolioItem(self, data=pkg) for pkg in res]
+
+    def _create_item(self, title, description, tags):
         url = ckan_url(self.username + "-" + title)
         data = {'name': url,
                 'title': title,
@@ -381,21 +680,79 @@ class StudentPortfolio:
                 'tags': [{'name': tag} for tag in tags],
                 'groups': [{'name': 'students-work'}]
                 }
-        pkg = url_retry(self.ckan, url, data)
-        self.reload()
-        return PortfolioItem(self, data=pkg)
+        res = url_retry(self.ckan, url, data)
+        replica.store_package(res)
+        return res
 
     def delete_all(self):
         raise NotImplementedError  # TODO
 
+    def tag_counts(self):
+        """Get number of portfolio items with each tag.
+
+        :return: Dictionary {tag: count}, None for portfolio
+                 created without counts
+        """
+        for extra in self.cv.get('extras', []):
+            if extra['key'] == 'tag_counts':
+                return json.loads(extra['value'])
+        return None
+
+    def update_tags(self, added=(), removed=()):
+        """Update tags of portfolio after tags of items were changed.
+        Only counts of changed tags are updated, items are not loaded.
+        Counts are read from CKAN again just before they are saved, so
+        changes made by other items meanwhile aren't lost (changes
+        made in this process wait for each other).
+
+        :param added: tags added to items, tag is repeated for every item
+                      (list or collections.Counter)
+        :param removed: tags removed from items
+        """
+        added = collections.Counter(added)
+        removed = collections.Counter(removed)
+        if not added and not removed:
+            return
+        with _portfolio_lock(self.cv['id']):
+            self.cv = self.ckan.call_action('package_show',
+                                            {'id': self.cv['id']})
+            counts = self.tag_counts()
+            if counts is None:
+                self.reload()
+                return
+            for tag, n in added.items():
+                counts[tag] = counts.get(tag, 0) + n
+            for tag, n in removed.items():
+                counts[tag] = counts.get(tag, 0) - n
+                if counts[tag] <= 0:
+                    del counts[tag]
+            self._save_tags(counts)
+
     def reload(self):
-        # get tags from all students works
-        tags = [tag for it in self.items() for tag in it.tags()]
-        tags = list(set(tags))  # make list unique
-        tags = [{'name': tag} for tag in tags]
+        """Count tags of all items again. Counts are updated by
+        items, so this is needed only for repair.
+        """
+        # get tags from all students works, as they are in CKAN
+        counts = collections.Counter(tag for it in self.iter_items(fresh=True)
+                                     for tag in set(it.tags()))
+        self.cv = self.ckan.call_action('package_show', {'id': self.cv['id']})
+        self._save_tags(dict(counts))
+
+    def _save_tags(self, counts):
+        extras = [extra for extra in self.cv.get('extras', [])
+                  if extra['key'] != 'tag_counts']
+        extras.append({'key': 'tag_counts',
+                       'value': json.dumps(counts, sort_keys=True)})
+        tags = [{'name': tag} for tag in sorted(counts)]
         res = self.ckan.call_action('package_patch', {'id': self.cv['id'],
-                                                      'tags': tags})
+                                                      'tags': tags,
+                                                      'extras': extras})
         self.cv = res
+        identity.store('package', res)
+        replica.store_package(res)
+        tag_index = index.shared()
+        if tag_index is not None:
+            tag_index.update(res)
 
     def change_university(self):
         raise NotImplementedError  # TODO hard operation
@@ -420,7 +777,8 @@ class PortfolioItem:
                                  .format(set(self.values) > set(data.keys())))
             self.item = data
         elif id is not None:
-            self.item = self.ckan.action.package_show(id=id)
+            self.item = identity.load(
+                'package', id, lambda: _package_show(self.ckan, id))
         else:
             raise AttributeError('Missing id or data')
 
@@ -434,15 +792,17 @@ class PortfolioItem:
 
     @property
     def name(self):
-        return self.name['name']
+        return self.item['name']
 
     @property
     def title(self):
-        return self.name['title']
+        return self.item['title']
 
     @title.setter
     def title(self, value):
         self.item = self.ckan.action.package_patch(id=self.id, title=value)
+        identity.store('package', self.item)
+        replica.store_package(self.item)
 
     @property
     def description(self):
@@ -452,6 +812,8 @@ class PortfolioItem:
     def description(self, value):
         self.item = self.ckan.action.package_patch(id=self.id,
                                                    description=value)
+        identity.store('package', self.item)
+        replica.store_package(self.item)
 
     def tags(self):
         return [tag['name'] for tag in self.item['tags']]
@@ -465,12 +827,22 @@ class PortfolioItem:
 
     def set_tags(self, tags):
         tags = list(set(tags))
+        # item may be older than CKAN (e.g. loaded from replica), while
+        # counts of portfolio must get changes against CKAN
+        old_tags = {tag['name'] for tag in self.ckan.call_action(
+            'package_show', {'id': self.id})['tags']}
         self.item = self.ckan.action.package_patch(
             id=self.id,
             tags=[{'name': tag} for tag in tags],)
-        self.portfolio.reload()
+        identity.store('package', self.item)
+        replica.store_package(self.item)
+        self.portfolio.update_tags(added=set(tags) - old_tags,
+                                   removed=old_tags - set(tags))
+        invalidate('tags_list', 'top_tags')
 
     values = ['id', 'tags', 'name', 'title', ]
+    # fields loaded by portfolio searches
+    fields = ['id', 'name', 'title', 'author', 'tags']
 
     def upload_file(self, title, description, file):
         """Upload file to item. It is possible to upload file only to
@@ -495,19 +867,78 @@ class PortfolioItem:
         raise NotImplementedError  # TODO
 
     def delete(self):
-        raise NotImplementedError  # TODO
+        """Delete item and remove its tags from portfolio.
+        """
+        # item may be older than CKAN (e.g. loaded from replica)
+        old_tags = [tag['name'] for tag in self.ckan.call_action(
+            'package_show', {'id': self.id})['tags']]
+        self.ckan.call_action('package_delete', {'id': self.id})
+        identity.forget('package', self.id)
+        replica.forget_package(self.id)
+        self.portfolio.update_tags(removed=old_tags)
+        invalidate('tags_list', 'top_tags')
 
 
 class Organization:
-    def __init__(self, ckan, id):
+    def __init__(self, ckan, id=None, *, data=None):
+        """Load organization from CKAN or make this class from
+        loaded data (e.g. from organization_list). Details missing in
+        data are loaded when they are accessed.
+
+        :param ckan: CKAN API
+        :param id: id or name of organization
+        :param data: dictionary of organization, must contain id
+        :raise AttributeError: id and data not provided
+        """
         self.ckan = ckan
-        self.org = ckan.call_action('organization_show',
-                                    {'id': id,
-                                     'include_users': False,
-                                     'include_followers': False})
+        self._changed = None
+        if data is not None:
+            self.org = data
+            self._loaded = False
+        elif id is not None:
+            self.org = self._show(ckan, id)
+            self._loaded = True
+        else:
+            raise AttributeError('Missing id or data')
+
+    @staticmethod
+    def _show(ckan, id):
+        def load():
+            org = replica.organization(id) if replica.available() else None
+            if org is None:
+                org = ckan.call_action('organization_show',
+                                       {'id': id,
+                                        'include_users': False,
+                                        'include_followers': False})
+            return org
+        return identity.load('organization', id, load)
+
+    def _field(self, key):
+        if key not in self.org and not self._loaded:
+            self.org = dict(self._show(self.ckan, self.org['id']),
+                            **self.org)
+            self._loaded = True
+        return self.org[key]
 
     @classmethod
-    def create_university(cls, ckan: ckanapi.RemoteCKAN,
+    def bulk_load(cls, ckan, names):
+        """Load more organizations by one CKAN call for every
+        ORGANIZATION_PAGE of them.
+
+        :param ckan: CKAN API
+        :param names: list of names of organizations
+        :return: list of Organization, in order of names,
+                 without not existing organizations
+        """
+        if not names:
+            return []
+        res = organization_list(ckan, names)
+        orgs = {org['name']: org for org in res}
+        return [cls(ckan, data=orgs[name]) for name in names
+                if name in orgs]
+
+    @classmethod
+    def create_university(cls, ckan: Client,
                           name, title, description=None):
         """Creates new university profile
 
@@ -518,23 +949,25 @@ class Organization:
         :raise NameAlreadyExistError:
         :raise ckanapi.CKANAPIError:
         """
-        return cls(ckan, cls._create_organization(
-            ckan, name, title, description, 'University')['id'])
+        org = cls._create_organization(
+            ckan, name, title, description, 'University')
+        invalidate('university_list')
+        return cls(ckan, data=org)
 
     @classmethod
-    def create_company(cls, ckan: ckanapi.RemoteCKAN,
+    def create_company(cls, ckan: Client,
                        name, title, description=None):
         """Creates new company profile.
         see create_university
         """
-        return cls(ckan, cls._create_organization(
-            ckan, name, title, description, 'Company')['id'])
+        return cls(ckan, data=cls._create_organization(
+            ckan, name, title, description, 'Company'))
 
     @staticmethod
     def _create_organization(ckan, name, title, description, category):
         """
 
-        :type ckan: ckanapi.RemoteCKAN
+        :type ckan: Client
         :raise NameAlreadyExistError: When name conflicts
         :raise ckanapi.CKANAPIError: superclass for CKAN related errors
         """
@@ -558,25 +991,44 @@ class Organization:
 
     @property
     def title(self):
-        return self.org['title']
+        return self._field('title')
 
     @title.setter
     def title(self, value):
-        self.org = self.ckan.action.organization_patch(
-            id=self.id, title=value)
+        self._update('title', value)
 
     @property
     def description(self):
-        return self.org['description']
+        return self._field('description')
 
     @description.setter
     def description(self, value):
-        self.org = self.ckan.action.organization_patch(
-            id=self.id, description=value)
+        self._update('description', value)
 
     @property
     def name(self):
-        return self.org['name']
+        return self._field('name')
+
+    @contextlib.contextmanager
+    def edit(self):
+        """Collect changes of attributes and save them by one patch
+        when block ends without exception. See User.edit
+        """
+        self._changed = set()
+        try:
+            yield self
+            if self._changed:
+                self.update({key: self.org[key] for key in self._changed})
+        finally:
+            self._changed = None
+
+    def _update(self, key, value):
+        if self._changed is None:
+            self.update({key: value})
+        else:
+            self.org = dict(self.org)
+            self.org[key] = value
+            self._changed.add(key)
 
     def update(self, values: dict):
         """Update information at once used input dictionary.
@@ -585,37 +1037,105 @@ class Organization:
         """
         values['id'] = self.id
         self.org = self.ckan.call_action('organization_patch', values)
+        identity.store('organization', self.org)
+        replica.store_organization(self.org)
+        invalidate('university_list')
 
     @property
     def image_url(self):
-        return self.org['image_display_url']
+        return self._field('image_display_url')
 
     def upload_logo(self, file):
         self.org = self.ckan.action.organization_patch(id=self.id,
                                                        image_upload=file)
+        identity.store('organization', self.org)
+        replica.store_organization(self.org)
 
     def is_university(self):
-        if not self.org['extras']:
-            return False
-        category = [extra['value'] for extra in self.org['extras']
-                    if extra['key'] == 'Category']
-        return category and category[0] == "University"
+        self._field('extras')
+        return category(self.org) == "University"
 
     def is_company(self):
-        if not self.org['extras']:
-            return False
-        category = [extra['value'] for extra in self.org['extras']
-                    if extra['key'] == 'Category']
-        return category and category[0] == "Company"
+        self._field('extras')
+        return category(self.org) == "Company"
 
     def delete(self):
         raise NotImplementedError
 
 
+def load_profile(user_id, viewer_id=None, items=10):
+    """Load everything shown on profile page of user. Independent CKAN
+    calls are made concurrently.
+    Format of returned dictionary:
+    {'student': {'fullname', 'about', 'email'},
+     'items': [{'title', 'tags'}, ...] (most recent work),
+     'uni_owned', 'uni_member', 'comp_owned', 'comp_member':
+        [{'id', 'title'}, ...] (organizations of user),
+     'recruit_bar': [{'id', 'title'}, ...] (organizations of viewer)
+    }
+
+    :param user_id: CKAN id of user
+    :param viewer_id: CKAN id of user viewing profile, None for anonymous
+    :param items: number of loaded portfolio items
+    :return: dictionary
+    """
+    if viewer_id is None or viewer_id == user_id:
+        user = User(user_id)
+        viewer = None if viewer_id is None else user
+    else:
+        user, viewer = parallel.gather(lambda: User(user_id),
+                                       lambda: User(viewer_id))
+
+    def recent_items():
+        try:
+            portfolio = user.student_portfolio()
+        except NotFound:
+            return []
+        return [{'title': item.title, 'tags': item.tags()}
+                for item in portfolio.iter_items(
+                    limit=items, sort='metadata_modified desc')]
+
+    calls = [lambda: user.memberships('admin'),
+             lambda: user.memberships('read'),
+             recent_items]
+    if viewer is not None and viewer is not user:
+        calls.append(lambda: viewer.memberships('admin'))
+    res = parallel.gather(*calls)
+    owned, member, recent = res[:3]
+    if viewer is None:
+        recruit = []
+    elif viewer is user:
+        recruit = owned
+    else:
+        recruit = res[3]
+
+    owned_ids = {org['id'] for org in owned}
+    member = [org for org in member if org['id'] not in owned_ids]
+
+    def short(orgs, university=None):
+        return [{'id': org['id'], 'title': org['title']} for org in orgs
+                if university is None or
+                (category(org) == "University") == university]
+
+    return {'student': {'fullname': user.fullname,
+                        'about': user.about,
+                        'email': user.email},
+            'items': recent,
+            'uni_owned': short(owned, True),
+            'uni_member': short(member, True),
+            'comp_owned': short(owned, False),
+            'comp_member': short(member, False),
+            'recruit_bar': short(recruit)}
+
+
 class UserCreateError(Exception):
     pass
 
 
+class UserConflictError(Exception):
+    pass
+
+
 class NotFound(Exception):
     pass
 
@@ -660,6 +1180,93 @@ def select(result, keys):
         return [{key: orig[key] for key in keys} for orig in result]
 
 
+def category(org):
+    """Category of organization (University or Company) from its extras.
+
+    :param org: organization dictionary with extras
+    :return: str or None
+    """
+    for extra in org.get('extras') or []:
+        if extra['key'] == 'Category':
+            return extra['value']
+    return None
+
+
+def package_search(ckan, fields=None, **params):
+    """Search packages. When fields are specified, CKAN returns only
+    these fields from its search index instead of full packages with
+    resources, extras and organization. Tags are returned in same
+    format as in full package: [{'name': tag}, ...]
+
+    :param ckan: CKAN API
+    :param fields: list of returned fields, None for full packages
+    :param params: parameters of CKAN action package_search
+    :return: Dictionary with keys count and results
+    """
+    if fields is None:
+        return ckan.call_action('package_search', params)
+    params['fl'] = list(fields)
+    res = ckan.call_action('package_search', params)
+    res['results'] = [{field: pkg.get(field) for field in fields}
+                      for pkg in res['results']]
+    if 'tags' in fields:
+        for pkg in res['results']:
+            pkg['tags'] = [{'name': tag} for tag in pkg['tags'] or []]
+    return res
+
+
+def _package_show(ckan, id):
+    """Load package from replica when it is available, else from CKAN.
+    """
+    if replica.available():
+        package = replica.package(id)
+        if package is not None:
+            return package
+    return ckan.action.package_show(id=id)
+
+
+def organization_list(ckan, names=None):
+    """Organizations with all fields and extras. CKAN returns at most
+    ckan.group_and_organization_list_all_fields_max of them at once,
+    so they are loaded by pages of ORGANIZATION_PAGE.
+
+    :param ckan: CKAN API
+    :param names: names of organizations, None for all
+    :return: list of organization dictionaries
+    """
+    res = []
+    while True:
+        params = {'all_fields': True,
+                  'include_extras': True,
+                  'offset': len(res),
+                  'limit': ORGANIZATION_PAGE}
+        if names is not None:
+            params['organizations'] = list(names)
+        page = ckan.call_action('organization_list', params)
+        res.extend(page)
+        if len(page) < ORGANIZATION_PAGE:
+            return res
+
+
+# portfolios share fixed number of locks, so their number doesn't grow
+_locks = [threading.Lock() for i in range(64)]
+
+
+def _portfolio_lock(id):
+    """Lock of portfolio, which serializes updates of its tag counts.
+    Lock is local to this process, updates made by other processes
+    (workers) still race between package_show and package_patch.
+    """
+    return _locks[hash(id) % len(_locks)]
+
+
+def quote(value):
+    """Solr phrase of value, quotes and backslashes in value are
+    escaped, so it can't change query.
+    """
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
 def ckan_url(text: str):
     """Make suitable string for CKAN url. This string is used
      in names of packages, users, organizations, groups,
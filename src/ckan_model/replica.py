@@ -0,0 +1,293 @@
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from .models import ReplicaOrganization, ReplicaPackage, ReplicaTag, \
+    ReplicaState
+
+# serve reads from local replica kept by sync_replica
+ENABLED = getattr(settings, 'CKAN_REPLICA', False)
+# seconds since last sync after which reads go to CKAN again
+MAX_STALENESS = getattr(settings, 'CKAN_REPLICA_MAX_STALENESS', 300)
+# seconds for which result of staleness check is remembered
+CHECK_TTL = 5
+# groups of replicated packages and their kind
+GROUPS = {'students': ReplicaPackage.PORTFOLIO,
+          'students-work': ReplicaPackage.ITEM}
+PAGE = 1000
+
+_local = threading.local()
+
+
+def available():
+    """Tell if reads can be served by replica, which is enabled and
+    was synced in last MAX_STALENESS seconds.
+
+    :return: bool
+    """
+    if not ENABLED:
+        return False
+    checked = getattr(_local, 'checked', None)
+    if checked is None or time.time() - checked[0] > CHECK_TTL:
+        synced = ReplicaState.objects.filter(key='synced_at').first()
+        fresh = synced is not None and \
+            time.time() - float(synced.value) <= MAX_STALENESS
+        checked = _local.checked = (time.time(), fresh)
+    return checked[1]
+
+
+def _category(org):
+    for extra in org.get('extras') or []:
+        if extra['key'] == 'Category':
+            return extra['value']
+    return None
+
+
+# writes
+
+
+def store_package(package):
+    """Put package written to CKAN into replica, so reads from replica
+    see it before next sync.
+
+    :param package: full package dictionary
+    """
+    if ENABLED:
+        _store_package(package)
+
+
+def _store_package(package):
+    # only portfolios and items are kept, deleted package is removed
+    kinds = [GROUPS[group['name']] for group in package.get('groups') or []
+             if group['name'] in GROUPS]
+    if not kinds or package.get('state', 'active') != 'active':
+        ReplicaPackage.objects.filter(id=package['id']).delete()
+        return
+    with transaction.atomic():
+        ReplicaPackage.objects.filter(name=package['name']) \
+            .exclude(id=package['id']).delete()
+        ReplicaPackage.objects.update_or_create(id=package['id'], defaults={
+            'name': package['name'],
+            'kind': kinds[0],
+            'creator_user_id': package['creator_user_id'],
+            'organization': (package.get('organization') or {}).get('name'),
+            'metadata_modified': package['metadata_modified'],
+            'data': json.dumps(package)})
+        tags = {tag['name'] for tag in package.get('tags') or []}
+        ReplicaTag.objects.filter(package_id=package['id']) \
+            .exclude(name__in=tags).delete()
+        existing = set(ReplicaTag.objects.filter(package_id=package['id'])
+                       .values_list('name', flat=True))
+        ReplicaTag.objects.bulk_create(
+            ReplicaTag(package_id=package['id'], name=name)
+            for name in tags - existing)
+
+
+def forget_package(id):
+    """Remove deleted package from replica.
+
+    :param id: id of package
+    """
+    if ENABLED:
+        ReplicaPackage.objects.filter(id=id).delete()
+
+
+def store_organization(org):
+    """Put organization written to CKAN into replica.
+
+    :param org: organization dictionary with extras
+    """
+    if ENABLED:
+        _store_organization(org)
+
+
+def _store_organization(org):
+    with transaction.atomic():
+        ReplicaOrganization.objects.filter(name=org['name']) \
+            .exclude(id=org['id']).delete()
+        ReplicaOrganization.objects.update_or_create(id=org['id'], defaults={
+            'name': org['name'],
+            'category': _category(org),
+            'data': json.dumps(org)})
+
+
+def _state(key, default=None):
+    state = ReplicaState.objects.filter(key=key).first()
+    return default if state is None else state.value
+
+
+def _set_state(key, value):
+    ReplicaState.objects.update_or_create(key=key,
+                                          defaults={'value': value})
+
+
+def sync(ckan, full=False):
+    """Copy portfolios, items and organizations changed since last sync
+    from CKAN. Packages are polled in order of metadata_modified, so
+    sync continues where previous one ended. Full sync also removes
+    packages deleted in CKAN, which incremental sync doesn't see
+    (deletions made by this site are removed from replica at once).
+
+    :param ckan: CKAN API of sysadmin
+    :param full: load all packages instead of changed ones
+    :return: dictionary {'organizations', 'packages', 'removed'} (counts)
+    """
+    begin = time.time()
+    orgs = []
+    while True:
+        # CKAN may return less than limit organizations with all fields
+        res = ckan.call_action('organization_list', {'all_fields': True,
+                                                     'include_extras': True,
+                                                     'offset': len(orgs),
+                                                     'limit': PAGE})
+        if not res:
+            break
+        orgs.extend(res)
+    for org in orgs:
+        _store_organization(org)
+    ReplicaOrganization.objects.exclude(
+        id__in=[org['id'] for org in orgs]).delete()
+
+    since = None if full else _state('modified')
+    params = {'q': ' OR '.join('groups:{}'.format(group)
+                               for group in GROUPS),
+              'sort': 'metadata_modified asc',
+              'start': 0,
+              'rows': PAGE}
+    if since is not None:
+        params['fq'] = 'metadata_modified:[{}Z TO *]'.format(since)
+    seen = set()
+    while True:
+        res = ckan.call_action('package_search', dict(params))
+        for package in res['results']:
+            _store_package(package)
+            seen.add(package['id'])
+            since = max(since or '', package['metadata_modified'])
+        params['start'] += PAGE
+        if params['start'] >= res['count'] or not res['results']:
+            break
+
+    removed = 0
+    if full:
+        removed = ReplicaPackage.objects.exclude(id__in=seen).delete()[0] \
+            if seen else ReplicaPackage.objects.all().delete()[0]
+    if since is not None:
+        _set_state('modified', since)
+    _set_state('synced_at', repr(begin))
+    return {'organizations': len(orgs),
+            'packages': len(seen),
+            'removed': removed}
+
+
+# reads
+
+
+def package(id):
+    """
+    :param id: id or name of package
+    :return: package dictionary, None when it is not in replica
+    """
+    row = ReplicaPackage.objects.filter(id=id).first() or \
+        ReplicaPackage.objects.filter(name=id).first()
+    return None if row is None else json.loads(row.data)
+
+
+def portfolio_of(user_id):
+    """
+    :param user_id: id of CKAN user
+    :return: portfolio package created by user, None when not in replica
+    """
+    row = ReplicaPackage.objects.filter(
+        kind=ReplicaPackage.PORTFOLIO, creator_user_id=user_id).first()
+    return None if row is None else json.loads(row.data)
+
+
+def items(user_id, limit=None, sort=None):
+    """Portfolio items created by user.
+
+    :param user_id: id of CKAN user
+    :param limit: maximal number of items
+    :param sort: 'metadata_modified desc' or None for order by name
+    :return: list of package dictionaries
+    """
+    rows = ReplicaPackage.objects.filter(kind=ReplicaPackage.ITEM,
+                                         creator_user_id=user_id)
+    if sort == 'metadata_modified desc':
+        rows = rows.order_by('-metadata_modified')
+    else:
+        rows = rows.order_by('name')
+    if limit is not None:
+        rows = rows[:limit]
+    return [json.loads(row.data) for row in rows]
+
+
+def organization(id):
+    """
+    :param id: id or name of organization
+    :return: organization dictionary, None when it is not in replica
+    """
+    row = ReplicaOrganization.objects.filter(id=id).first() or \
+        ReplicaOrganization.objects.filter(name=id).first()
+    return None if row is None else json.loads(row.data)
+
+
+def universities():
+    """
+    :return: list of organization dictionaries
+    """
+    return [json.loads(row.data) for row in ReplicaOrganization.objects
+            .filter(category='University').order_by('name')]
+
+
+def tags_list():
+    return list(ReplicaTag.objects.order_by('name')
+                .values_list('name', flat=True).distinct())
+
+
+def top_tags(limit=10):
+    """
+    :return: list of dictionaries {'name', 'count'} by count
+    """
+    return list(ReplicaTag.objects.values('name')
+                .annotate(count=Count('package'))
+                .order_by('-count', 'name')[:limit])
+
+
+def search(tags, universities, start, rows, ranked=False, cursor=None):
+    """Search portfolios as Search.students does in CKAN: by any of
+    tags, optionally ranked by number of matched tags, or ordered by
+    name and continued after (before) name in cursor.
+
+    :return: dictionary {'count', 'results'}, results contain
+             id, name, title and tags of portfolios
+    """
+    portfolios = ReplicaPackage.objects.filter(kind=ReplicaPackage.PORTFOLIO)
+    if universities:
+        portfolios = portfolios.filter(organization__in=universities)
+    if tags:
+        # filtered join, so count is number of matched tags
+        portfolios = portfolios.filter(tags__name__in=tags) \
+            .annotate(matched=Count('tags'))
+    if ranked:
+        portfolios = portfolios.order_by('-matched', 'name')
+    elif cursor is None:
+        portfolios = portfolios.order_by('name')
+    elif 'after' in cursor:
+        portfolios = portfolios.filter(name__gt=cursor['after']) \
+            .order_by('name')
+    else:
+        portfolios = portfolios.filter(name__lt=cursor['before']) \
+            .order_by('-name')
+    results = []
+    for row in portfolios[start:start + rows]:
+        package = json.loads(row.data)
+        results.append({'id': package['id'],
+                        'name': package['name'],
+                        'title': package['title'],
+                        'tags': [{'name': tag['name']}
+                                 for tag in package['tags']]})
+    return {'count': portfolios.count(), 'results': results}
@@ -1,8 +1,46 @@
-from django.test import TestCase
-from . import production
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from search import views as search_views
+from . import production, index, cursor, parallel, cache, metrics, \
+    identity, policy, client, fake, benchmark, loadtest, replica, \
+    views as ckan_views
+from .models import PortfolioLink
+import io
+import requests
+import threading
 import uuid
 import time
 
+_backend = None
+
+
+def _fake_ckan():
+    """Fake CKAN with university lut, which tests expect.
+    """
+    ckan = fake.FakeCKAN()
+    ckan.call_action('organization_create',
+                     {'name': 'lut',
+                      'title': 'Lappeenranta University of Technology',
+                      'extras': [{'key': 'Category',
+                                  'value': 'University'}]},
+                     apikey=production.sysadmin.apikey)
+    return ckan
+
+
+def setUpModule():
+    # tests run offline unless CKAN_TESTS_LIVE is set
+    global _backend
+    if not getattr(settings, 'CKAN_TESTS_LIVE', False):
+        _backend = client.install(_fake_ckan())
+
+
+def tearDownModule():
+    if not getattr(settings, 'CKAN_TESTS_LIVE', False):
+        client.install(_backend)
+
 
 class UserTest(TestCase):
     def setUp(self):
@@ -17,6 +55,41 @@ class UserTest(TestCase):
         u = self._user()
         self.assertFalse(u.is_student())
 
+    def test_edit_user(self):
+        u = self._user()
+        with u.edit():
+            u.fullname = 'Full Name'
+            u.about = 'About'
+        u = production.User(u.id)
+        self.assertEqual(u.fullname, 'Full Name')
+        self.assertEqual(u.about, 'About')
+
+    def test_edit_concurrent(self):
+        u = self._user()
+        first, second, third = [production.User(u.id) for i in range(3)]
+        first.fullname = 'First'
+        second.about = 'Second'
+        u = production.User(u.id)
+        self.assertEqual(u.fullname, 'First')
+        self.assertEqual(u.about, 'Second')
+        # third was loaded before fullname was changed by first
+        with self.assertRaises(production.UserConflictError):
+            third.fullname = 'Other'
+        self.assertEqual(third.fullname, u.user['name'])
+        self.assertEqual(production.User(u.id).fullname, 'First')
+        third.fullname = 'First'  # same value isn't conflict
+        self.assertEqual(third.about, 'Second')
+
+    def test_edit_rollback(self):
+        u = self._user()
+        fullname = u.fullname
+        with self.assertRaises(ValueError):
+            with u.edit():
+                u.fullname = 'Full Name'
+                raise ValueError
+        self.assertEqual(u.fullname, fullname)
+        self.assertEqual(production.User(u.id).fullname, fullname)
+
     def _user(self):
         name = Helper.get_name()
         u = production.User.create_new(name, "user@name.example", name)
@@ -32,6 +105,24 @@ class UserTest(TestCase):
         p = u.student_portfolio()
         return p
 
+    def test_universities(self):
+        u = self._user()
+        u.add_to_organization('lut')  # TODO make general
+        self.assertListEqual([org.name for org in u.universities()],
+                             ['lut'])
+        self.assertListEqual(list(u.companies()), [])
+
+    def test_many_memberships(self):
+        # CKAN returns at most 25 organizations with all fields at once
+        u = self._user()
+        names = sorted(Helper.get_name() for _ in range(30))
+        for name in names:
+            production.Organization.create_company(production.sysadmin,
+                                                   name, name)
+            u.add_to_organization(name)
+        self.assertListEqual(sorted(org.name for org in u.companies()),
+                             names)
+
     def test_create_student_profile(self):
         u = self._user()
         self.assertRaises(production.NotFound, u.student_portfolio)
@@ -96,6 +187,22 @@ class UserTest(TestCase):
         self.assertTrue(len(p1.tags()) == 0, "1st portfolio after reload")
 
 
+class ProfileTest(TransactionTestCase):
+    # portfolio links are read by gathered calls in other threads
+    def test_load_profile(self):
+        name = Helper.get_name()
+        u = production.User.create_new(name, "user@name.example", name)
+        u.add_to_organization('lut')  # TODO make general
+        profile = production.load_profile(u.id, u.id)
+        self.assertListEqual([org['id'] for org in profile['uni_member']],
+                             [production.Organization(production.sysadmin,
+                                                     'lut').id])
+        self.assertListEqual(profile['comp_member'], [])
+        self.assertListEqual(profile['items'], [])
+        self.assertEqual(profile['recruit_bar'],
+                         profile['uni_owned'] + profile['comp_owned'])
+
+
 class PortfolioTest(TestCase):
     def setUp(self):
         name = Helper.get_name()
@@ -138,6 +245,374 @@ class PortfolioTest(TestCase):
         self.assertEqual(len(p.tags()), 2)
         self.assertListEqual(p.tags(), ['test3', 'test4'])
 
+    def test_iter_items_of_creator(self):
+        name = Helper.get_name()
+        other = production.User.create_new(name, "user@name.example", name)
+        other.add_to_organization('lut')
+        other.create_student_profile()
+        self.user.student_portfolio().add_item('Mine', 'description', [])
+        other.student_portfolio().add_item('Other', 'description', [])
+        self.assertListEqual(
+            [i.title for i in self.user.student_portfolio().iter_items()],
+            ['Mine'])
+        self.assertListEqual(
+            [i.title for i in other.student_portfolio().iter_items()],
+            ['Other'])
+
+    def test_iter_items_author_mismatch(self):
+        p = self.user.student_portfolio()
+        item = p.add_item('Name', 'description', [])
+        production.sysadmin.call_action('package_patch',
+                                        {'id': item.id, 'author': 'other'})
+        self.assertRaises(production.CKANConsistentError, list,
+                          self.user.student_portfolio().iter_items())
+
+    def test_tag_counts(self):
+        p = self.user.student_portfolio()
+        self.assertDictEqual(p.tag_counts(), {})
+        i1 = p.add_item('Name', 'description', ['test1', 'test2'])
+        i2 = p.add_item('Name', 'description', ['test2'])
+        self.assertDictEqual(p.tag_counts(), {'test1': 1, 'test2': 2})
+        i1.set_tags(['test3'])
+        self.assertDictEqual(p.tag_counts(), {'test2': 1, 'test3': 1})
+        i2.delete()
+        self.assertListEqual(p.tags(), ['test3'])
+        p.reload()
+        self.assertDictEqual(p.tag_counts(), {'test3': 1})
+
+    def test_tag_counts_concurrent(self):
+        # two requests edit different items, each with its own copy of
+        # portfolio loaded before the other edit
+        p = self.user.student_portfolio()
+        p.add_item('First', 'description', ['test1'])
+        p.add_item('Second', 'description', ['test2'])
+        first = {i.title: i for i in
+                 self.user.student_portfolio().iter_items()}['First']
+        second = {i.title: i for i in
+                  self.user.student_portfolio().iter_items()}['Second']
+        first.add_tags('test3')
+        second.add_tags('test3')
+        self.assertDictEqual(self.user.student_portfolio().tag_counts(),
+                             {'test1': 1, 'test2': 1, 'test3': 2})
+        first.set_tags(['test1'])
+        second.set_tags([])
+        p = self.user.student_portfolio()
+        self.assertDictEqual(p.tag_counts(), {'test1': 1})
+        p.reload()
+        self.assertDictEqual(p.tag_counts(), {'test1': 1})
+
+    def test_stale_link(self):
+        p = self.user.student_portfolio()
+        link = PortfolioLink.objects.get(user_id=self.user.id)
+        self.assertEqual(link.portfolio_id, p.cv['id'])
+        link.portfolio_id = 'deleted-portfolio'
+        link.save()
+        self.assertEqual(self.user.student_portfolio().cv['id'],
+                         p.cv['id'])
+        link = PortfolioLink.objects.get(user_id=self.user.id)
+        self.assertEqual(link.portfolio_id, p.cv['id'])
+
+    def test_backfill(self):
+        p = self.user.student_portfolio()
+        PortfolioLink.objects.all().delete()
+        out = io.StringIO()
+        call_command('backfill_portfolios', stdout=out)
+        self.assertIn('portfolios linked', out.getvalue())
+        link = PortfolioLink.objects.get(user_id=self.user.id)
+        self.assertEqual(link.portfolio_id, p.cv['id'])
+
+    def test_add_items(self):
+        p = self.user.student_portfolio()
+        res = p.add_items([
+            {'title': 'Name', 'description': '', 'tags': ['test1']},
+            {'title': 'Name', 'description': '', 'tags': ['test1', 'test2']},
+        ])
+        for item in res:
+            self.assertIsInstance(item, production.PortfolioItem)
+        self.assertDictEqual(p.tag_counts(), {'test1': 2, 'test2': 1})
+
+
+class OrganizationTest(TestCase):
+    def setUp(self):
+        self.names = sorted(Helper.get_name() for _ in range(30))
+        for name in self.names:
+            production.Organization.create_company(production.sysadmin,
+                                                   name, name.upper())
+
+    def test_bulk_load(self):
+        metrics.start()
+        orgs = production.Organization.bulk_load(production.sysadmin,
+                                                 self.names + ['missing'])
+        self.assertListEqual([org.name for org in orgs], self.names)
+        for org in orgs:
+            self.assertTrue(org.is_company())
+            org.title, org.image_url
+        # one call for every 25 organizations, nothing loaded lazily
+        self.assertEqual(len(metrics.stop()), 2)
+
+    def test_lazy_fields(self):
+        orgs = [production.Organization(production.sysadmin,
+                                        data={'id': org.id})
+                for org in production.Organization.bulk_load(
+                    production.sysadmin, self.names[:3])]
+        metrics.start()
+        for _ in range(2):
+            self.assertListEqual([org.title for org in orgs],
+                                 [name.upper() for name in self.names[:3]])
+        self.assertListEqual([call.action for call in metrics.stop()],
+                             ['organization_show'] * 3)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        if getattr(settings, 'CKAN_TESTS_LIVE', False):
+            self.skipTest('needs empty CKAN')
+        self.backend = client.install(_fake_ckan())
+        cache.invalidate('tags_list', 'top_tags', 'university_list')
+        for name, tags in (('anna', ['PHP', 'Python']),
+                           ('bob', ['Python']),
+                           ('cyril', ['CKAN'])):
+            user = production.User.create_new(name, 'user@name.example',
+                                              name.capitalize())
+            user.add_to_organization('lut')
+            portfolio = user.create_student_profile()
+            portfolio.add_item('Work', 'Description', tags)
+        self.search = production.Search(use_index=False)
+
+    def tearDown(self):
+        client.install(self.backend)
+
+    def test_students(self):
+        r = self.search.students(['Python', 'CKAN'])
+        self.assertEqual(r['total'], 3)
+        r = self.search.students(['Python'], ['lut'])
+        self.assertListEqual([x['title'] for x in r['results']],
+                             ['Anna', 'Bob'])
+        self.assertListEqual(r['results'][0]['tags_unmatched'], ['PHP'])
+        self.assertEqual(self.search.students(['Java'])['total'], 0)
+
+    def test_ranked(self):
+        r = self.search.students(['PHP', 'Python', 'CKAN'], ranked=True)
+        self.assertListEqual([x['title'] for x in r['results']],
+                             ['Anna', 'Bob', 'Cyril'])
+        r = self.search.students(['Python', 'CKAN'], ranked=True,
+                                 weighted=True, rows=1)
+        self.assertListEqual([x['title'] for x in r['results']], ['Cyril'])
+
+    def test_cursor(self):
+        r = self.search.students(rows=2)
+        r = self.search.students(rows=2, cursor=r['next'])
+        self.assertListEqual([x['title'] for x in r['results']], ['Cyril'])
+        r = self.search.students(rows=2, cursor=r['prev'])
+        self.assertListEqual([x['title'] for x in r['results']],
+                             ['Anna', 'Bob'])
+
+    def test_cursor_injection(self):
+        c = cursor.encode({'after': 'x" TO *] OR name:"a',
+                           'position': 0, 'total': 3})
+        r = self.search.students(rows=2, cursor=c)
+        self.assertListEqual(r['results'], [])
+
+    def test_ranked_has_no_cursor(self):
+        # tag searches of search view are ranked and paged by position
+        r = self.search.students(['Python', 'CKAN'], rows=2, ranked=True)
+        self.assertIsNone(r['next'])
+        r = self.search.students(['Python', 'CKAN'], start=2, rows=2,
+                                 ranked=True)
+        self.assertListEqual([x['title'] for x in r['results']], ['Cyril'])
+        self.assertRaises(ValueError, self.search.students, ['Python'],
+                          ranked=True, cursor=r['prev'] or 'x')
+
+    def test_index_loading(self):
+        # Solr answers until index is loaded
+        loading = threading.Event()
+
+        class Slow:
+            def call_action(self, action, data_dict=None):
+                loading.wait(5)
+                return {'count': 0, 'results': []}
+
+        tag_index = index.TagIndex(Slow())
+        search = production.Search(tag_index=tag_index)
+        self.assertEqual(search.students(['Python'])['total'], 2)
+        loading.set()
+        tag_index.thread.join()
+
+    def test_view_bad_page(self):
+        factory = RequestFactory()
+        for query in ({'cursor': 'garbage'}, {'page': 'x'}, {'page': '-1'},
+                      {'selected_tags': 'Python', 'cursor': 'garbage'}):
+            request = factory.get('/search/', query)
+            request.user = AnonymousUser()
+            response = search_views.search(request)
+            self.assertEqual(response.status_code, 200)
+
+    def test_tags(self):
+        self.assertListEqual(self.search.tags_list(),
+                             ['CKAN', 'PHP', 'Python'])
+        self.assertListEqual([tag['name'] for tag in self.search.top_tags(1)],
+                             ['Python'])
+        self.assertListEqual(self.search.university_list(), [
+            {'name': 'lut', 'title': 'Lappeenranta University of Technology'}])
+
+    def test_university_edit(self):
+        self.search.university_list()
+        with production.Organization(production.sysadmin, 'lut').edit() as org:
+            org.title = 'LUT University'
+        self.assertListEqual(self.search.university_list(), [
+            {'name': 'lut', 'title': 'LUT University'}])
+
+    def test_permissions(self):
+        user = production.User.create_new('eve', 'eve@name.example', 'Eve')
+        self.assertRaises(PermissionError, user.create_student_profile)
+        self.assertRaises(production.ckanapi.NotAuthorized,
+                          user.ckan.call_action, 'package_create',
+                          {'name': 'eve', 'owner_org': 'lut'})
+
+
+class ReplicaTest(SearchTest):
+    """Tests of SearchTest with reads served by replica.
+    """
+    def setUp(self):
+        super().setUp()
+        replica.ENABLED = True
+        replica._local.checked = None
+        replica.sync(production.sysadmin, full=True)
+        cache.invalidate('tags_list', 'top_tags', 'university_list')
+
+    def tearDown(self):
+        replica.ENABLED = False
+        replica._local.checked = None
+        super().tearDown()
+
+    def test_view_bad_page(self):
+        self.skipTest('view reads replica in worker threads, which SQLite '
+                      'locks out during transaction of TestCase')
+
+    def test_no_calls(self):
+        metrics.start()
+        self.search.students(['Python'], ['lut'])
+        self.search.students(['PHP', 'Python'], ranked=True)
+        self.search.tags_list()
+        portfolio = production.StudentPortfolio(
+            production.sysadmin, username='anna',
+            user_id=production.User('anna').id)
+        self.assertEqual(len(list(portfolio.iter_items())), 1)
+        production.Organization(production.sysadmin, 'lut')
+        self.assertListEqual(
+            [call.action for call in metrics.stop()], ['user_show'])
+
+    def test_writes(self):
+        user = production.User('bob')
+        portfolio = user.student_portfolio()
+        portfolio.add_item('Other work', 'Description', ['Java'])
+        r = self.search.students(['Java'])
+        self.assertListEqual([x['title'] for x in r['results']], ['Bob'])
+        for item in portfolio.iter_items():
+            if item.title == 'Other work':
+                item.delete()
+        self.assertEqual(self.search.students(['Java'])['total'], 0)
+
+    def test_incremental(self):
+        user = production.User.create_new('dave', 'user@name.example',
+                                          'Dave')
+        user.add_to_organization('lut')
+        user.create_student_profile().add_item('Work', 'Text', ['Java'])
+        replica.ENABLED = False  # written only to CKAN
+        user.student_portfolio().add_item('Next', 'Text', ['Go'])
+        replica.ENABLED = True
+        self.assertEqual(self.search.students(['Go'])['total'], 0)
+        res = replica.sync(production.sysadmin)
+        self.assertLess(res['packages'], 8)
+        self.assertEqual(self.search.students(['Go'])['total'], 1)
+
+    def test_write_stale_item(self):
+        user = production.User('bob')
+        replica.ENABLED = False  # written only to CKAN
+        item = next(user.student_portfolio().iter_items())
+        item.set_tags(['Python', 'Go'])
+        replica.ENABLED = True
+        portfolio = user.student_portfolio()
+        item = next(portfolio.iter_items())
+        self.assertListEqual(item.tags(), ['Python'])  # from replica
+        item.set_tags(['Rust'])
+        cv = production.sysadmin.call_action('package_show',
+                                             {'id': portfolio.cv['id']})
+        portfolio.cv = cv
+        self.assertDictEqual(portfolio.tag_counts(), {'Rust': 1})
+        portfolio.reload()
+        self.assertDictEqual(portfolio.tag_counts(), {'Rust': 1})
+
+    def test_delete_stale_item(self):
+        user = production.User('bob')
+        replica.ENABLED = False
+        item = next(user.student_portfolio().iter_items())
+        item.set_tags(['Python', 'Go'])
+        replica.ENABLED = True
+        portfolio = user.student_portfolio()
+        item = next(portfolio.iter_items())
+        self.assertListEqual(item.tags(), ['Python'])  # from replica
+        item.delete()
+        portfolio.cv = production.sysadmin.call_action(
+            'package_show', {'id': portfolio.cv['id']})
+        self.assertDictEqual(portfolio.tag_counts(), {})
+
+    def test_stale(self):
+        replica.ReplicaState.objects.filter(key='synced_at').update(
+            value=repr(time.time() - replica.MAX_STALENESS - 1))
+        replica._local.checked = None
+        self.assertFalse(replica.available())
+
+
+class BenchmarkTest(TransactionTestCase):
+    def test_budgets(self):
+        with benchmark.environment(students=50) as data:
+            results = [benchmark.run(name, data, repeat=0)
+                       for name in benchmark.SCENARIOS]
+        self.assertListEqual(
+            benchmark.over_budget(results, benchmark.load_budgets()), [])
+        for result in results:
+            self.assertGreater(result.calls, 0)
+
+    def test_environment_isolated(self):
+        tags = production.Search().tags_list()
+        version = cache._version('tags_list')
+        with benchmark.environment(students=5) as data:
+            self.assertEqual(len(data['students']), 5)
+            self.assertIsNone(production.Search(
+                tag_index=index.TagIndex(),
+                use_index=False).tag_index)
+            benchmark.run('search', data, repeat=1)
+            self.assertNotEqual(production.Search().tags_list(), tags)
+        self.assertEqual(cache._version('tags_list'), version)
+        self.assertListEqual(production.Search().tags_list(), tags)
+        self.assertFalse(User.objects.filter(
+            username__startswith='benchmark-').exists())
+
+    def test_command_without_timing(self):
+        out = io.StringIO()
+        call_command('benchmark', 'search', students=5, repeat=0,
+                     stdout=out)
+        self.assertRegex(out.getvalue(), r'search +- +1 ')
+
+
+class LoadTestTest(TestCase):
+    def test_report(self):
+        samples = [loadtest.Sample('/', 200, i / 100) for i in range(1, 101)]
+        samples.append(loadtest.Sample('/search/', 500, 1.0))
+        r = loadtest.report(samples, elapsed=10)
+        self.assertListEqual([x['route'] for x in r],
+                             ['/', '/search/', 'total'])
+        self.assertEqual(r[0]['p50'], 0.5)
+        self.assertEqual(r[0]['p99'], 0.99)
+        self.assertEqual(r[0]['rps'], 10)
+        self.assertEqual(r[1]['errors'], 1)
+        self.assertIsNone(r[1]['p50'])  # every request failed
+        self.assertEqual(r[2]['requests'], 101)
+        lines = loadtest.table(r)
+        self.assertEqual(len(lines), 4)
+        self.assertRegex(lines[2], r'^/search/ +1 +1 +0\.1 +- +- +-$')
+
 
 class StaticTest(TestCase):
     def test_select(self):
@@ -166,7 +641,467 @@ class StaticTest(TestCase):
         self.assertNotEqual(r3, data)
         self.assertListEqual(r4, data)
 
+    def test_category(self):
+        self.assertEqual(production.category(
+            {'extras': [{'key': 'Category', 'value': 'University'}]}),
+            'University')
+        self.assertIsNone(production.category({'extras': []}))
+        self.assertIsNone(production.category({}))
+
+    def test_package_search_fields(self):
+        class Ckan:
+            def call_action(self, action, data_dict):
+                self.params = data_dict
+                return {'count': 1, 'results': [
+                    {'id': '1', 'name': 'n', 'tags': ['a', 'b']}]}
+
+        ckan = Ckan()
+        res = production.package_search(ckan, ['id', 'title', 'tags'],
+                                        q='groups:students')
+        self.assertListEqual(ckan.params['fl'], ['id', 'title', 'tags'])
+        self.assertDictEqual(res['results'][0], {
+            'id': '1', 'title': None,
+            'tags': [{'name': 'a'}, {'name': 'b'}]})
+
+    def test_cursor(self):
+        c = cursor.encode({'after': 'name', 'position': 10, 'total': 15})
+        self.assertEqual(cursor.decode(c)['after'], 'name')
+        self.assertRaises(ValueError, cursor.decode, 'garbage')
+        for state in ({'after': 10 ** 9, 'position': 0, 'total': 1},
+                      {'after': -1, 'position': 0, 'total': 1},
+                      {'after': 1, 'position': 'x', 'total': 1},
+                      {'after': 1, 'position': 2, 'total': 1},
+                      {'after': 1, 'before': 2, 'position': 0, 'total': 1}):
+            self.assertRaises(ValueError, cursor.decode,
+                              cursor.encode(state), int, 100)
+        c = cursor.encode({'after': ['"'], 'position': 0, 'total': 1})
+        self.assertRaises(ValueError, cursor.decode, c)
+        c = cursor.encode({'after': 3, 'position': 0, 'total': 1, 'x': 1})
+        self.assertDictEqual(cursor.decode(c, int, 100),
+                             {'after': 3, 'position': 0, 'total': 1})
+        prev, next = cursor.page('a', 'b', 10, 5, 5, 15)
+        self.assertEqual(cursor.decode(prev)['position'], 5)
+        self.assertIsNone(next)
+
+
+class TagIndexTest(TestCase):
+    class Packages:
+        def __init__(self, packages):
+            self.packages = packages
+
+        def call_action(self, action, data_dict=None):
+            return {'count': len(self.packages), 'results': self.packages}
+
+    @staticmethod
+    def _package(id, tags, university='lut'):
+        return {'id': id, 'name': id, 'title': id.upper(),
+                'tags': [{'name': tag} for tag in tags],
+                'organization': {'name': university},
+                'metadata_modified': '2015-11-0{}T00:00:00'.format(len(id))}
+
+    def setUp(self):
+        self.index = index.TagIndex(self.Packages([
+            self._package('a', ['PHP', 'Python']),
+            self._package('b', ['Python'], 'but'),
+            self._package('c', ['CKAN'])]), refresh=None)
+        self.index.refresh()
+
+    def test_filters(self):
+        r = self.index.students(['Python'])
+        self.assertEqual(r['total'], 2)
+        self.assertListEqual([x['name'] for x in r['results']], ['a', 'b'])
+        self.assertListEqual(r['results'][0]['tags_matched'], ['Python'])
+        self.assertListEqual(r['results'][0]['tags_unmatched'], ['PHP'])
+        r = self.index.students(['Python', 'CKAN'], ['lut'])
+        self.assertListEqual([x['name'] for x in r['results']], ['a', 'c'])
+        self.assertEqual(self.index.students()['total'], 3)
+
+    def test_pagination(self):
+        r = self.index.students(start=1, rows=1)
+        self.assertEqual(r['total'], 3)
+        self.assertListEqual([x['name'] for x in r['results']], ['b'])
+
+    def test_ranked(self):
+        self.index.update(self._package('d', ['CKAN', 'Python']))
+        r = self.index.students(['Python', 'CKAN'], ranked=True)
+        self.assertEqual(r['total'], 4)
+        self.assertListEqual([x['name'] for x in r['results']],
+                             ['d', 'a', 'b', 'c'])
+        r = self.index.students(['PHP', 'Python'], ranked=True,
+                                weighted=True, rows=1)
+        self.assertListEqual([x['name'] for x in r['results']], ['a'])
+        r = self.index.students(['PHP', 'CKAN'], ranked=True,
+                                weighted=True, start=1, rows=2)
+        self.assertListEqual([x['name'] for x in r['results']], ['c', 'd'])
+
+    def test_cursor(self):
+        r = self.index.students(rows=2)
+        self.assertIsNone(r['prev'])
+        r = self.index.students(rows=2, cursor=cursor.decode(r['next'], int))
+        self.assertListEqual([x['name'] for x in r['results']], ['c'])
+        self.assertEqual(r['start'], 2)
+        self.assertIsNone(r['next'])
+        r = self.index.students(rows=2, cursor=cursor.decode(r['prev'], int))
+        self.assertListEqual([x['name'] for x in r['results']], ['a', 'b'])
+        self.assertEqual(r['start'], 0)
+
+    def test_update_remove(self):
+        self.index.update(self._package('a', ['CKAN']))
+        self.assertEqual(self.index.count('Python'), 1)
+        self.assertEqual(self.index.count('CKAN'), 2)
+        self.index.remove('c')
+        self.assertEqual(self.index.count('CKAN'), 1)
+        self.index.update(self._package('d', ['PHP']))
+        self.assertEqual(self.index.count('PHP'), 1)
+        self.assertEqual(self.index.students()['total'], 3)
+
+    def test_background_load(self):
+        loading = threading.Event()
+
+        class Slow(self.Packages):
+            def call_action(self, action, data_dict=None):
+                loading.wait(5)
+                self.params = data_dict
+                return super().call_action(action, data_dict)
+
+        tag_index = index.TagIndex(Slow([self._package('a', ['PHP'])]))
+        self.assertFalse(tag_index.ready())
+        self.assertEqual(tag_index.students(['PHP'])['total'], 0)
+        loading.set()
+        tag_index.thread.join()
+        self.assertTrue(tag_index.ready())
+        self.assertEqual(tag_index.students(['PHP'])['total'], 1)
+        self.assertIn('tags', tag_index.ckan.params['fl'])
+
+    def test_fields(self):
+        tag_index = index.TagIndex(self.Packages([{
+            'id': 'a', 'name': 'a', 'title': 'A', 'tags': ['PHP'],
+            'organization': 'lut', 'metadata_modified': '2015'}]),
+            refresh=None)
+        tag_index.refresh()
+        r = tag_index.students(['PHP'], ['lut'])
+        self.assertListEqual(r['results'][0]['tags_matched'], ['PHP'])
+
+    def test_rebuild(self):
+        # c deleted in CKAN, b lost tag Python
+        self.index.ckan.packages = [self._package('a', ['PHP', 'Python']),
+                                    self._package('b', ['Go'], 'but')]
+        self.index.refresh()
+        self.assertEqual(self.index.count('CKAN'), 1)
+        self.index.rebuild_interval = 0
+        self.index.refresh_interval = 0
+        self.assertTrue(self.index.ready())  # rebuild in background
+        self.index.thread.join()
+        r = self.index.students(['Python', 'CKAN', 'Go'])
+        self.assertListEqual([x['name'] for x in r['results']], ['a', 'b'])
+        self.assertEqual(self.index.count('Python'), 1)
+        self.assertEqual(self.index.count('CKAN'), 0)
+
+
+class ParallelTest(TestCase):
+    def test_gather(self):
+        # every call waits for others, so it passes only when they overlap
+        barrier = threading.Barrier(3, timeout=5)
+
+        def meet(value):
+            barrier.wait()
+            return value
+
+        r = parallel.gather(lambda: meet(1), lambda: meet(2),
+                            lambda: parallel.gather(lambda: meet(3)))
+        self.assertListEqual(r, [1, 2, [3]])
+
+    def test_gather_errors(self):
+        def fail():
+            raise production.NotFound
+
+        self.assertRaises(production.NotFound,
+                          parallel.gather, time.time, fail)
+        self.assertRaises(parallel.concurrent.futures.TimeoutError,
+                          parallel.gather, time.time, lambda: time.sleep(1),
+                          timeout=0.1)
+
+    def test_each(self):
+        running = []
+
+        def work(n):
+            running.append(n)
+            time.sleep(0.05)
+            count = len(running)
+            running.remove(n)
+            if n == 3:
+                raise ValueError
+            return count
+
+        r = parallel.each(work, range(8), limit=2)
+        self.assertEqual(len(r), 8)
+        self.assertIsInstance(r[3], ValueError)
+        self.assertTrue(all(n <= 2 for i, n in enumerate(r) if i != 3))
+
+
+class CacheTest(TestCase):
+    def setUp(self):
+        self.loads = 0
+        cache.invalidate('test')
+
+    def _load(self):
+        self.loads += 1
+        return self.loads
+
+    def test_cached(self):
+        self.assertEqual(cache.get('test', (), self._load, ttl=60), 1)
+        self.assertEqual(cache.get('test', (), self._load, ttl=60), 1)
+        self.assertEqual(cache.get('test', (1,), self._load, ttl=60), 2)
+        cache.invalidate('test')
+        self.assertEqual(cache.get('test', (), self._load, ttl=60), 3)
+
+    def test_stale(self):
+        self.assertEqual(cache.get('test', (), self._load, ttl=0), 1)
+        key = cache._key('test', ())
+        cache.backend.add(key + ':lock', 1)
+        self.assertEqual(cache.get('test', (), self._load, ttl=0), 1)
+        cache.backend.delete(key + ':lock')
+        self.assertEqual(cache.get('test', (), self._load, ttl=0), 2)
+
+
+    def test_loaded_while_waiting(self):
+        key = cache._key('test', ())
+        backend = cache.backend
+
+        class Racing:
+            # other caller stores value and releases lock just before add
+            def __getattr__(self, name):
+                return getattr(backend, name)
+
+            def add(self, *args):
+                backend.set(key, (7, time.time() + 60), 60)
+                return backend.add(*args)
+
+        cache.backend = Racing()
+        try:
+            self.assertEqual(cache.get('test', (), self._load, ttl=60), 7)
+        finally:
+            cache.backend = backend
+        self.assertEqual(self.loads, 0)
+        self.assertIsNone(backend.get(key + ':lock'))
+
+    def test_keyword_arguments(self):
+        test = self
+
+        class Data:
+            @cache.cached('test')
+            def values(self, limit=10):
+                test.loads += 1
+                return list(range(limit))
+
+        self.assertListEqual(Data().values(limit=3), [0, 1, 2])
+        self.assertListEqual(Data().values(limit=3), [0, 1, 2])
+        self.assertListEqual(Data().values(limit=2), [0, 1])
+        self.assertEqual(self.loads, 2)
+        self.assertEqual(len(production.Search(use_index=False)
+                             .top_tags(limit=3)), 0)
+
+
+class PolicyTest(TestCase):
+    def setUp(self):
+        self.breaker, self.backoff = policy.breaker, policy.BACKOFF
+        policy.breaker = policy.Breaker(failures=3, reset=60)
+        policy.BACKOFF = 0
+        self.attempts = []
+
+    def tearDown(self):
+        policy.breaker, policy.BACKOFF = self.breaker, self.backoff
+        policy.stop()
+
+    def _failing(self, timeout):
+        self.attempts.append(timeout)
+        raise requests.ConnectionError
+
+    def test_retry_reads(self):
+        self.assertRaises(requests.ConnectionError, policy.call,
+                          'package_search', self._failing)
+        self.assertEqual(len(self.attempts), 1 + policy.RETRIES)
+        self.assertEqual(self.attempts[0], policy.TIMEOUTS['package_search'])
+
+    def test_no_retry_writes(self):
+        self.assertRaises(requests.ConnectionError, policy.call,
+                          'package_create', self._failing)
+        self.assertEqual(len(self.attempts), 1)
+
+    def test_retry_read_for_user(self):
+        self.assertRaises(requests.ConnectionError, policy.call,
+                          'organization_list_for_user', self._failing)
+        self.assertEqual(len(self.attempts), 1 + policy.RETRIES)
+
+    def test_no_retry_unknown(self):
+        # actions not known to only read aren't repeated
+        self.assertRaises(requests.ConnectionError, policy.call,
+                          'package_revise', self._failing)
+        self.assertRaises(requests.ConnectionError, policy.call,
+                          'api_token_list', self._failing)
+        self.assertEqual(len(self.attempts), 2)
+
+    def test_no_retry_errors(self):
+        def not_found(timeout):
+            self.attempts.append(timeout)
+            raise production.NotFound('x')
+        self.assertRaises(production.NotFound, policy.call,
+                          'package_show', not_found)
+        self.assertEqual(len(self.attempts), 1)
+        self.assertFalse(policy.breaker.is_open)
+
+    def test_breaker(self):
+        for i in range(3):
+            self.assertRaises(requests.ConnectionError, policy.call,
+                              'package_create', self._failing)
+        self.assertTrue(policy.breaker.is_open)
+        self.assertRaises(policy.Unavailable, policy.call,
+                          'package_show', lambda timeout: 1)
+        self.assertEqual(len(self.attempts), 3)
+        policy.breaker.reset = 0
+        self.assertEqual(policy.call('package_show', lambda timeout: 1), 1)
+        self.assertFalse(policy.breaker.is_open)
+
+    def test_breaker_counts_calls(self):
+        # failed attempts of one read are one failure
+        for i in range(2):
+            self.assertRaises(requests.ConnectionError, policy.call,
+                              'package_search', self._failing)
+        self.assertEqual(len(self.attempts), 2 * (1 + policy.RETRIES))
+        self.assertFalse(policy.breaker.is_open)
+
+    def test_breaker_deadline_timeout(self):
+        def slow(timeout):
+            self.attempts.append(timeout)
+            raise requests.ReadTimeout
+
+        policy.start(budget=0.5)  # shorter than timeout of action
+        for i in range(5):
+            self.assertRaises(requests.ReadTimeout, policy.call,
+                              'package_show', slow)
+        self.assertLess(max(self.attempts), policy.TIMEOUTS['default'])
+        self.assertFalse(policy.breaker.is_open)
+        policy.stop()
+        for i in range(3):
+            self.assertRaises(requests.ReadTimeout, policy.call,
+                              'package_create', slow)
+        self.assertTrue(policy.breaker.is_open)
+
+    def test_deadline(self):
+        policy.start(budget=2)
+        self.assertLessEqual(
+            policy.call('package_show', lambda timeout: timeout), 2)
+        policy.start(budget=0)
+        self.assertRaises(policy.DeadlineExceeded, policy.call,
+                          'package_show', lambda timeout: 1)
+
+    def test_stale_cache(self):
+        cache.invalidate('test')
+        self.assertEqual(cache.get('test', (), lambda: 1, ttl=0), 1)
+        self.assertEqual(
+            cache.get('test', (), lambda: self._failing(None), ttl=0), 1)
+
+
+class CoalesceTest(TestCase):
+    class Client(client.Client):
+        calls = 0
+
+        def _call(self, action, data_dict, context, files):
+            type(self).calls += 1
+            time.sleep(0.2)
+            if action == 'status_show':
+                raise policy.Unavailable(action)
+            return {'action': action, 'data': data_dict}
+
+    def setUp(self):
+        self.Client.calls = 0
+
+    def test_coalesce(self):
+        ckan = self.Client()
+        results = parallel.gather(
+            *[lambda: ckan.action.tag_list(vocabulary_id='a')] * 4)
+        self.assertEqual(self.Client.calls, 1)
+        self.assertEqual(results[0], results[3])
+        self.assertIsNot(results[0], results[3])
+
+    def test_not_coalesced(self):
+        parallel.gather(
+            lambda: self.Client().action.tag_list(vocabulary_id='a'),
+            lambda: self.Client().action.tag_list(vocabulary_id='b'),
+            lambda: self.Client('key').action.tag_list(vocabulary_id='a'),
+            lambda: self.Client().action.package_create(name='a'),
+            lambda: self.Client().action.package_create(name='a'))
+        self.assertEqual(self.Client.calls, 5)
+
+    def test_error(self):
+        ckan = self.Client()
+        results = parallel.each(lambda i: ckan.action.status_show(),
+                                range(3))
+        self.assertEqual(self.Client.calls, 1)
+        for result in results:
+            self.assertIsInstance(result, policy.Unavailable)
+
+
+class MetricsTest(TestCase):
+    def test_request_calls(self):
+        metrics.start()
+        metrics.record('user_show', 0.02, 100)
+        parallel.gather(
+            lambda: metrics.record('tag_list', 0.2, 10),
+            lambda: metrics.record('tag_list', 0.3, None, KeyError()))
+        calls = metrics.stop()
+        self.assertEqual(len(calls), 3)
+        self.assertSetEqual({call.action for call in calls},
+                            {'user_show', 'tag_list'})
+        self.assertListEqual([call.error for call in calls if call.error],
+                             ['KeyError'])
+        self.assertListEqual(metrics.stop(), [])
+
+    def test_export(self):
+        metrics.record('test_action', 0.3, 10)
+        text = metrics.export()
+        self.assertIn('ckan_call_seconds_bucket{action="test_action",'
+                      'le="0.5"}', text)
+        self.assertIn('ckan_call_seconds_count{action="test_action"}', text)
+
+    def test_view_access(self):
+        request = RequestFactory().get('/metrics/', REMOTE_ADDR='10.0.0.1')
+        request.user = AnonymousUser()
+        self.assertRaises(PermissionDenied, ckan_views.metrics, request)
+        request.user = User(username='admin', is_staff=True)
+        self.assertEqual(ckan_views.metrics(request).status_code, 200)
+        request = RequestFactory().get('/metrics/', REMOTE_ADDR='127.0.0.1')
+        request.user = AnonymousUser()
+        self.assertEqual(ckan_views.metrics(request).status_code, 200)
+
+
+class IdentityTest(TestCase):
+    def setUp(self):
+        self.loads = 0
+
+    def _load(self):
+        self.loads += 1
+        return {'id': 'id-1', 'name': 'name-1'}
+
+    def test_without_request(self):
+        identity.load('user', 'id-1', self._load)
+        identity.load('user', 'id-1', self._load)
+        self.assertEqual(self.loads, 2)
 
+    def test_scope(self):
+        with identity.scope():
+            u1 = identity.load('user', 'id-1', self._load)
+            u2 = identity.load('user', 'name-1', self._load)
+            u3, = parallel.gather(
+                lambda: identity.load('user', 'id-1', self._load))
+            self.assertIs(u1, u2)
+            self.assertIs(u1, u3)
+            self.assertEqual(self.loads, 1)
+            identity.forget('user', 'id-1')
+            identity.load('user', 'name-1', self._load)
+            self.assertEqual(self.loads, 2)
+            identity.load('organization', 'id-1', self._load)
+            self.assertEqual(self.loads, 3)
 
 
 class Helper:
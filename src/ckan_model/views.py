@@ -0,0 +1,13 @@
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+
+from .metrics import export
+
+
+def metrics(request):
+    # scraped by monitoring from INTERNAL_IPS, others must be staff
+    if not (request.user.is_staff or
+            request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS):
+        raise PermissionDenied
+    return HttpResponse(export(), content_type='text/plain; version=0.0.4')
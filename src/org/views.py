@@ -15,8 +15,9 @@ def show_organization(request, org_id):
         else:
             payload['can_edit'] = True
         if request.method == 'POST' and payload['can_edit']:
-            this_org.title = request.POST['title']
-            this_org.description = request.POST['description']
+            with this_org.edit():
+                this_org.title = request.POST['title']
+                this_org.description = request.POST['description']
         payload['name'] = this_org.name
         payload['title'] = this_org.title
         payload['description'] = this_org.description
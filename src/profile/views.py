@@ -17,48 +17,36 @@ def show_profile(request, user_id):
     selected_user = User.objects.get(username=user_id)
 
     if selected_user.first_name:
+        viewer_id = getattr(request.user, 'first_name', None) or None
         try:
-            ckan_selected_user = ckan.User(id=selected_user.first_name)
-            payload['student'] = {
-                'fullname': ckan_selected_user.fullname,
-                'about': ckan_selected_user.about,
-                'email': ckan_selected_user.email
-            }
-            admin_of = ckan_selected_user.admin_of()
-            member_of = ckan_selected_user.member_of()
-            payload['uni_owned'] = [{
-                        'title': org.title,
-                        'link': linkFactory.getOrg(org.id),
-                        } for org in admin_of if org.is_university]
-            payload['uni_member'] = [{
-                        'title': org.title,
-                        'link': linkFactory.getOrg(org.id),
-                        }  for org in member_of if org.is_university and org not in admin_of]
-            payload['comp_owned'] = [{
-                        'title': org.title,
-                        'link': linkFactory.getOrg(org.id),
-                        }  for org in admin_of if not org.is_university]
-            payload['comp_member'] = [{
-                        'title': org.title,
-                        'link': linkFactory.getOrg(org.id),
-                        }  for org in member_of if not org.is_university and org not in admin_of]
-            if request.user.first_name:
-                ckan_this_user = ckan.User(id=request.user.first_name)
-                if request.method == 'POST':
-                    ckan_this_user.add_to_organization(
-                        organization=request.POST['company'],
-                        )
-                recruit_bar = []
-                for comp in ckan_this_user.admin_of():
-                    recruit_bar.append({
-                        'title': comp.title,
-                        'id': comp.id,
-                        })
-                payload['action'] = recruit_bar
+            if request.method == 'POST' and 'fullname' in request.POST \
+                    and selected_user == request.user:
+                ckan_selected_user = ckan.User(id=selected_user.first_name)
+                with ckan_selected_user.edit():
+                    ckan_selected_user.fullname = request.POST['fullname']
+                    ckan_selected_user.about = request.POST['about']
+                    ckan_selected_user.email = request.POST['email']
+            if request.method == 'POST' and 'company' in request.POST \
+                    and viewer_id:
+                ckan.User(id=viewer_id).add_to_organization(
+                    organization=request.POST['company'],
+                    )
+
+            profile = ckan.load_profile(selected_user.first_name, viewer_id)
+            payload['student'] = profile['student']
+            payload['items'] = profile['items']
+            for key in ('uni_owned', 'uni_member', 'comp_owned',
+                        'comp_member'):
+                payload[key] = [{
+                    'title': org['title'],
+                    'link': linkFactory.getOrg(org['id']),
+                    } for org in profile[key]]
+            if viewer_id:
+                payload['action'] = profile['recruit_bar']
 
         except Exception as e:
             payload['warning'] = repr(e)
-    
+
     return render(request, 'profile.html', payload)
 
 
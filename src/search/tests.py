@@ -1,4 +1,72 @@
+import csv
+import io
+import json
+
+from django.conf import settings
 from django.test import TestCase, RequestFactory
 from django.contrib.auth.models import AnonymousUser, User
 
-# Create your tests here.
+from ckan_model import cache, client, fake, production
+from . import views
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        if getattr(settings, 'CKAN_TESTS_LIVE', False):
+            self.skipTest('needs empty CKAN')
+        ckan = fake.FakeCKAN()
+        ckan.call_action('organization_create',
+                         {'name': 'lut',
+                          'title': 'Lappeenranta University of Technology',
+                          'extras': [{'key': 'Category',
+                                      'value': 'University'}]},
+                         apikey=production.sysadmin.apikey)
+        self.backend = client.install(ckan)
+        cache.invalidate('tags_list', 'top_tags', 'university_list')
+        for name, tags in (('anna', ['PHP', 'Python']),
+                           ('bob', ['Python']),
+                           ('cyril', ['CKAN'])):
+            user = production.User.create_new(name, 'user@name.example',
+                                              name.capitalize())
+            user.add_to_organization('lut')
+            portfolio = user.create_student_profile()
+            portfolio.add_item('Work', 'Description', tags)
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user('recruiter')
+
+    def tearDown(self):
+        client.install(self.backend)
+
+    def _export(self, user, **params):
+        request = self.factory.get('/search/export/',
+                                   dict(params, selected_tags='Python'))
+        request.user = user
+        return views.export(request)
+
+    def test_csv(self):
+        response = self._export(self.user)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('students.csv', response['Content-Disposition'])
+        text = b''.join(response.streaming_content).decode()
+        rows = list(csv.reader(io.StringIO(text)))
+        self.assertListEqual(rows, [
+            ['name', 'title', 'tags_matched', 'tags_unmatched'],
+            [rows[1][0], 'Anna', 'Python', 'PHP'],
+            [rows[2][0], 'Bob', 'Python', '']])
+
+    def test_jsonl(self):
+        response = self._export(self.user, format='jsonl')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn('students.jsonl', response['Content-Disposition'])
+        students = [json.loads(line) for line in b''.join(
+            response.streaming_content).decode().splitlines()]
+        self.assertListEqual([student['title'] for student in students],
+                             ['Anna', 'Bob'])
+        self.assertListEqual(students[0]['tags_unmatched'], ['PHP'])
+
+    def test_anonymous(self):
+        response = self._export(AnonymousUser())
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(settings.LOGIN_URL))
@@ -1,10 +1,15 @@
+import csv
+import itertools
+import json
 import urllib.parse
 
+from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
 
 
-#from ckan_model import stub as ckan
+# set CKAN_BACKEND = 'ckan_model.fake.FakeCKAN' to run without CKAN
 from ckan_model import production as ckan
+from ckan_model.parallel import gather
 
 #from ..ckan_model import production as ckan
 import django.http
@@ -21,41 +26,112 @@ def search(request: django.http.HttpRequest):
     # it's a search engine!
     google = ckan.Search()
     payload = {}
-    payload['tags'] = google.tags_list()
-    payload['unis'] = google.university_list()
 
-    page = int(request.GET.get('page', 1))
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        page = 1
     page_size = 10
     start_pos = (page - 1) * page_size
+    cursor = request.GET.get('cursor')
+    tags = request.GET.getlist('selected_tags')
+    unis = request.GET.getlist('selected_unis')
 
-    if request.GET:
-        response = google.students(request.GET.getlist('selected_tags'),
-                                   request.GET.getlist('selected_unis'),
-                                   start=start_pos,
-                                   rows=page_size
-                                   )
-    else:
-        response = google.students()
+    def students():
+        # searches by tags are ranked and paged by position, ranked
+        # results have no cursors; cursors page through students
+        # listed without tags, where deep pages are common
+        try:
+            return google.students(tags, unis, start=start_pos,
+                                   rows=page_size, ranked=not cursor,
+                                   cursor=cursor)
+        except ValueError:
+            # malformed cursor from client, first page is shown
+            return google.students(tags, unis, rows=page_size, ranked=True)
+
+    payload['tags'], payload['unis'], response = gather(
+        google.tags_list, google.university_list, students)
 
     total = response['total']
     pages_count = total//10+bool(total%10)
-    actual_page = start_pos//page_size + 1
+    actual_page = response['start']//page_size + 1
 
     parsed_url = list(urllib.parse.urlparse(request.get_full_path()))
-    options = dict(urllib.parse.parse_qsl(parsed_url[4]))
+    options = [(key, value)
+               for key, value in urllib.parse.parse_qsl(parsed_url[4])
+               if key not in ('page', 'cursor')]
 
-    def change_url(n):
-        options['page'] = n
-        parsed_url[4] = urllib.parse.urlencode(options)
+    def change_url(n, cursor=None):
+        query = options + [('page', n)]
+        if cursor:
+            query.append(('cursor', cursor))
+        parsed_url[4] = urllib.parse.urlencode(query)
         return urllib.parse.urlunparse(parsed_url)
 
+    # only pages around actual page are linked
+    window = 3
     pages = [{'number': n,
               'url': change_url(n),
-              'active': n == actual_page} for n in range(1, pages_count)]
+              'active': n == actual_page}
+             for n in range(max(1, actual_page - window),
+                            min(pages_count, actual_page + window) + 1)]
 
-    payload["pagination"] = { "pages": pages,
-                              "prev": actual_page > 1,
-                              "next": actual_page < pages_count,
-                              }
+    payload["pagination"] = {"pages": pages,
+                             "prev": actual_page > 1,
+                             "next": actual_page < pages_count,
+                             "prev_url": change_url(actual_page - 1,
+                                                    response['prev']),
+                             "next_url": change_url(actual_page + 1,
+                                                    response['next']),
+                             }
     payload['results'] = response['results']
-    return render(request, 'search.html', payload)
\ No newline at end of file
+    return render(request, 'search.html', payload)
+
+
+class Echo:
+    """File-like object which returns written value instead of
+    storing it. csv.writer then produces rows for streaming.
+    """
+    def write(self, value):
+        return value
+
+
+def chunks(lines, size=100):
+    """Join lines into chunks, so response is not written row by row.
+    """
+    while True:
+        chunk = ''.join(itertools.islice(lines, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+@login_required
+def export(request: django.http.HttpRequest):
+    # all found students as CSV or JSON lines, streamed page by page
+    google = ckan.Search()
+    students = google.iter_students(request.GET.getlist('selected_tags'),
+                                    request.GET.getlist('selected_unis'))
+
+    if request.GET.get('format') == 'jsonl':
+        lines = (json.dumps(student) + '\n' for student in students)
+        content_type = 'application/x-ndjson'
+        filename = 'students.jsonl'
+    else:
+        writer = csv.writer(Echo())
+        lines = itertools.chain(
+            [writer.writerow(['name', 'title',
+                              'tags_matched', 'tags_unmatched'])],
+            (writer.writerow([student['name'],
+                              student['title'],
+                              ';'.join(student['tags_matched']),
+                              ';'.join(student['tags_unmatched'])])
+             for student in students))
+        content_type = 'text/csv'
+        filename = 'students.csv'
+
+    response = django.http.StreamingHttpResponse(chunks(lines),
+                                                 content_type=content_type)
+    response['Content-Disposition'] = \
+        'attachment; filename="{}"'.format(filename)
+    return response
@@ -25,6 +25,9 @@ SECRET_KEY = 'n&901w0bsh+pi6wmzlp(g8*!9*m$*w&!yx0@&qv(^k0(*kujkc'
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# addresses allowed to read /metrics/ without staff login (monitoring)
+INTERNAL_IPS = ['127.0.0.1']
+
 ALLOWED_HOSTS = []
 
 
@@ -41,10 +44,14 @@ INSTALLED_APPS = (
     'search',
     'job',
     'profile',
+    'ckan_model',
 
 )
 
 MIDDLEWARE_CLASSES = (
+    'ckan_model.middleware.CKANMetricsMiddleware',
+    'ckan_model.middleware.IdentityMapMiddleware',
+    'ckan_model.middleware.CKANDeadlineMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -112,8 +119,70 @@ STATIC_URL = '/static/'
 
 # other stuff
 
+LOGIN_URL = '/auth/login/'
 LOGIN_REDIRECT_URL = '/'
 
+# CKAN
+
+CKAN_URL = 'http://ckan.local'
+CKAN_SYSADMIN_APIKEY = 'cd609119-9305-48bb-8b9c-5b3083252d80'
+
+# class used instead of CKAN at CKAN_URL,
+# 'ckan_model.fake.FakeCKAN' keeps CKAN in memory for offline development
+CKAN_BACKEND = None
+
+# run ckan_model tests against CKAN at CKAN_URL instead of fake CKAN
+CKAN_TESTS_LIVE = False
+
+# size of keep-alive connection pool to CKAN host
+CKAN_POOL_SIZE = 10
+
+# organizations loaded with all fields by one call, at most
+# ckan.group_and_organization_list_all_fields_max of CKAN
+CKAN_ORGANIZATION_PAGE = 25
+
+# identical concurrent reads share one CKAN call
+CKAN_COALESCE = True
+
+# answer student search from in-process tag index,
+# refreshed from CKAN every CKAN_TAG_INDEX_REFRESH seconds and loaded
+# again every CKAN_TAG_INDEX_REBUILD seconds to drop deleted portfolios
+CKAN_TAG_INDEX = False
+CKAN_TAG_INDEX_REFRESH = 30
+CKAN_TAG_INDEX_REBUILD = 3600
+
+# read students, portfolios and organizations from local replica kept
+# by ./manage.py sync_replica, while its last sync is not older than
+# CKAN_REPLICA_MAX_STALENESS seconds (then reads go to CKAN)
+CKAN_REPLICA = False
+CKAN_REPLICA_MAX_STALENESS = 300
+
+# threads for concurrent CKAN calls and seconds to wait for them
+CKAN_WORKERS = 8
+CKAN_GATHER_TIMEOUT = 30
+
+# seconds to wait for one CKAN action and for all CKAN calls of request
+CKAN_TIMEOUTS = {
+    'package_search': 10,
+    'default': 5,
+}
+CKAN_REQUEST_BUDGET = 20
+
+# failed reads are retried with random backoff starting at CKAN_BACKOFF
+# seconds, after CKAN_BREAKER_FAILURES failures in row CKAN isn't called
+# for CKAN_BREAKER_RESET seconds
+CKAN_RETRIES = 2
+CKAN_BACKOFF = 0.1
+CKAN_BREAKER_FAILURES = 5
+CKAN_BREAKER_RESET = 30
+
+# seconds for which rarely changing CKAN data are cached
+CKAN_CACHE_TTL = {
+    'tags_list': 300,
+    'top_tags': 300,
+    'university_list': 600,
+}
+
 # if dependencies for coverage installed use it
 try:
     import coverage
@@ -18,14 +18,17 @@ from django.conf.urls import include, url
 from django.conf.urls.static import static
 from django.contrib import admin, auth
 
+from ckan_model import views as ckan_views
 from search import views as search_views
 
 
 urlpatterns = [
     url(r'^$', search_views.index),
     url(r'^auth/', include('authentication.urls')),
+    url(r'^search/export/$', search_views.export, name='search_export'),
     url(r'^search/', search_views.search, name='search'),
     url(r'^profile/', include('profile.urls')),
     url(r'^organization/', include('org.urls')),
     url(r'^administration/', include(admin.site.urls)),
+    url(r'^metrics/$', ckan_views.metrics),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)